@@ -4,11 +4,35 @@
 # In[22]:
 
 
+import csv
+import hashlib
+import io
+import os
+import threading
+from contextlib import contextmanager
 import openpyxl
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import extras, pool, sql
 from datetime import datetime
 
+# pandas is optional; without it the row-by-row comparison is used
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Rows per COPY buffer when staging the sheet for a server-side diff
+COPY_CHUNK_SIZE = 10000
+
+# Table that receives ingestion timestamps when write_back='audit_table'
+INGESTION_AUDIT_TABLE = 'excel_ingestion_audit'
+
+# Rows per round trip when streaming stored rows through a server-side cursor
+FETCH_ITERSIZE = 10000
+
+# Append-only log of the old and new value of every column an update changed, per run id
+CHANGELOG_TABLE = 'excel_sync_changelog'
+
 # Function to create PostgreSQL connection
 def create_postgres_connection(db_params):
     try:
@@ -25,6 +49,74 @@ def create_postgres_connection(db_params):
         print(f"Error connecting to PostgreSQL Database: {e}")
         return None
 
+# Connections are pooled per db_params and shared by every load in the process.
+# psycopg2 keeps at most POOL_MIN_CONNECTIONS idle connections between checkouts.
+POOL_MIN_CONNECTIONS = 2
+POOL_MAX_CONNECTIONS = 10
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_params, min_connections=POOL_MIN_CONNECTIONS, max_connections=POOL_MAX_CONNECTIONS):
+    pool_key = tuple(sorted(db_params.items()))
+    with _connection_pools_lock:
+        if pool_key not in _connection_pools:
+            connection_pool = pool.ThreadedConnectionPool(
+                min_connections,
+                max_connections,
+                dbname=db_params['database'],
+                user=db_params['user'],
+                password=db_params['password'],
+                host=db_params['host'],
+                port=db_params['port']
+            )
+            # getconn raises once the pool is exhausted, so checkouts wait for a slot first
+            _connection_pools[pool_key] = (connection_pool, threading.BoundedSemaphore(max_connections))
+            print("PostgreSQL connection pool created successfully.")
+        return _connection_pools[pool_key]
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        for connection_pool, _ in _connection_pools.values():
+            connection_pool.closeall()
+        _connection_pools.clear()
+
+def connection_is_healthy(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def postgres_session(db_params, statement_timeout=None):
+    # Check out a pooled connection, replacing it if it has gone stale, and hand it back
+    # with the session reset. statement_timeout is in milliseconds.
+    connection_pool, slots = get_connection_pool(db_params)
+    slots.acquire()
+    connection = None
+    try:
+        connection = connection_pool.getconn()
+        if not connection_is_healthy(connection):
+            connection_pool.putconn(connection, close=True)
+            connection = connection_pool.getconn()
+        if statement_timeout is not None:
+            with connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (statement_timeout,))
+            connection.commit()
+        yield connection
+    finally:
+        if connection is not None:
+            try:
+                connection.reset()
+            except psycopg2.Error:
+                connection.close()
+            connection_pool.putconn(connection, close=bool(connection.closed))
+        slots.release()
+
 # Function to check if a table exists in the PostgreSQL database
 def table_exists(connection, table_name):
     try:
@@ -36,109 +128,386 @@ def table_exists(connection, table_name):
         return False
 
 # Function to fetch existing data from the database
-def fetch_existing_data(connection, table_name, primary_key):
+def fetch_existing_data(connection, table_name, primary_key, itersize=FETCH_ITERSIZE):
+    # Rows arrive itersize at a time through a server-side cursor instead of one fetchall()
     try:
-        with connection.cursor() as cursor:
+        with connection.cursor(name=f"{table_name}_existing") as cursor:
+            cursor.itersize = itersize
             cursor.execute(f"SELECT * FROM {table_name}")
-            rows = cursor.fetchall()
+            # A named cursor only has a description once something has been fetched
+            first_rows = cursor.fetchmany(itersize)
             columns = [desc[0] for desc in cursor.description]
-        data_dict = {row[columns.index(primary_key)]: row for row in rows}
+            key_index = columns.index(primary_key)
+            data_dict = {row[key_index]: row for row in first_rows}
+            for row in cursor:
+                data_dict[row[key_index]] = row
+        connection.commit()
         return data_dict, columns
     except psycopg2.Error as e:
         print(f"Error fetching existing data: {e}")
+        connection.rollback()
         return {}, []
 
+def row_hash(values):
+    # Compact fingerprint of values as compared by the row-by-row loop (through str())
+    return hashlib.md5('\x1f'.join([str(value) for value in values]).encode('utf-8')).digest()
+
+def fetch_existing_hashes(connection, table_name, primary_key, compare_columns, itersize=FETCH_ITERSIZE):
+    # Streams only the key and compare_columns through a server-side cursor and keeps a
+    # 16-byte hash per key, so memory grows with the number of keys, not the table width
+    try:
+        projection = ', '.join([f'"{col}"' for col in [primary_key] + compare_columns])
+        existing_hashes = {}
+        with connection.cursor(name=f"{table_name}_existing_hashes") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(f"SELECT {projection} FROM {table_name}")
+            for row in cursor:
+                existing_hashes[str(row[0])] = row_hash(row[1:])
+        connection.commit()
+        return existing_hashes
+    except psycopg2.Error as e:
+        print(f"Error fetching existing row hashes: {e}")
+        connection.rollback()
+        return {}
+
+def find_changed_rows_by_hash(columns, rows, existing_hashes, primary_key, exclude_columns=['ingestion_timestamp']):
+    # Same result as the row-by-row comparison, against the hashes from fetch_existing_hashes.
+    # Returns the changed row indexes and rows.
+    key_index = columns.index(primary_key)
+    compare_indexes = [i for i, col in enumerate(columns) if col != primary_key and col not in exclude_columns]
+    updated_rows = []
+    rows_to_update = []
+    for idx, row in enumerate(rows):
+        existing_hash = existing_hashes.get(str(row[key_index]))
+        if existing_hash is not None and existing_hash != row_hash([row[i] for i in compare_indexes]):
+            rows_to_update.append(row)
+            updated_rows.append(idx)
+    return updated_rows, rows_to_update
+
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_buffer(rows):
+    # NULL is spelled \N so empty strings survive the round trip
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if cell is None else str(cell).lower() if isinstance(cell, bool) else cell for cell in row])
+    buffer.seek(0)
+    return buffer
+
+# Function to find changed rows on the server instead of pulling the whole table
+def fetch_changed_rows(connection, table_name, columns, data, primary_key, exclude_columns=['ingestion_timestamp'], chunk_size=COPY_CHUNK_SIZE, return_rows=False):
+    # The sheet is COPYed into a temp table and compared with IS DISTINCT FROM, so only
+    # the indexes (into data) of changed rows and of keys missing from the table come back.
+    # With return_rows the staged values come back too, as (index, row) pairs, so data
+    # can be a one-pass stream
+    try:
+        with connection.cursor() as cursor:
+            stage_table = f"{table_name}_diff"
+            stage_columns = ', '.join([f'"{col}"' for col in columns])
+            compare_columns = [col for col in columns if col != primary_key and col not in exclude_columns]
+
+            cursor.execute(f"CREATE TEMP TABLE {stage_table} (LIKE {table_name}, sheet_row_number BIGSERIAL) ON COMMIT DROP")
+            copy_sql = f"COPY {stage_table} ({stage_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+            for chunk in chunked(data, chunk_size):
+                cursor.copy_expert(copy_sql, csv_buffer(chunk))
+
+            changed_filter = ''
+            if compare_columns:
+                target_values = ', '.join([f't."{col}"' for col in compare_columns])
+                stage_values = ', '.join([f's."{col}"' for col in compare_columns])
+                changed_filter = f' OR ({target_values}) IS DISTINCT FROM ({stage_values})'
+
+            row_values = ''.join([f', s."{col}"' for col in columns]) if return_rows else ''
+            cursor.execute(f"""
+                SELECT s.sheet_row_number - 1, t."{primary_key}" IS NULL{row_values}
+                FROM {stage_table} s
+                LEFT JOIN {table_name} t ON t."{primary_key}" = s."{primary_key}"
+                WHERE t."{primary_key}" IS NULL{changed_filter}
+                ORDER BY s.sheet_row_number
+            """)
+            changed_rows = []
+            missing_rows = []
+            for row_idx, missing, *values in cursor:
+                entry = (row_idx, values) if return_rows else row_idx
+                if missing:
+                    missing_rows.append(entry)
+                else:
+                    changed_rows.append(entry)
+        connection.commit()
+        return changed_rows, missing_rows
+    except psycopg2.Error as e:
+        print(f"Error computing changed rows: {e}")
+        connection.rollback()
+        return [], []
+
+# Function to normalize a DataFrame for comparison (needs pandas)
+def normalize_frame(frame):
+    # str() of every value, with missing values spelled 'None' like str(None)
+    return frame.astype(object).where(frame.notna(), 'None').astype(str)
+
+# Function to find changed rows with one vectorized comparison per column (needs pandas)
+def find_changed_rows_columnar(columns, rows, existing_data, existing_columns, primary_key, exclude_columns=['ingestion_timestamp']):
+    # Values are compared through str(), as in the row-by-row loop, but each conversion and
+    # comparison runs over a whole column at once. Returns the changed row indexes and rows.
+    sheet = pd.DataFrame(rows, columns=columns, dtype=object)
+    sheet['sheet_row_number'] = range(len(sheet))
+    compare_columns = [col for col in columns if col != primary_key and col not in exclude_columns]
+    existing = pd.DataFrame(list(existing_data.values()), columns=existing_columns, dtype=object)[[primary_key] + compare_columns]
+
+    merged = sheet.merge(existing, on=primary_key, how='inner', suffixes=('', '_db')).sort_values('sheet_row_number')
+    changed = pd.Series(False, index=merged.index)
+    for col in compare_columns:
+        changed |= normalize_frame(merged[[col]])[col] != normalize_frame(merged[[col + '_db']])[col + '_db']
+
+    merged = merged[changed]
+    return merged['sheet_row_number'].tolist(), merged[columns].values.tolist()
+
 # Function to update data in the PostgreSQL table
-def update_data_in_postgres(connection, table_name, columns, data, primary_key):
+def new_run_id():
+    # Labels a run's changes. Runs overlap, so it orders runs by start, not by commit;
+    # read the changelog incrementally with read_changelog, not with run_id > last seen.
+    return datetime.now().strftime('%Y%m%dT%H%M%S%f')
+
+def ensure_changelog_table(connection):
     try:
         with connection.cursor() as cursor:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CHANGELOG_TABLE} (
+                    change_id BIGSERIAL PRIMARY KEY,
+                    run_id TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    column_name TEXT NOT NULL,
+                    old_value TEXT,
+                    new_value TEXT,
+                    changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    txid BIGINT NOT NULL DEFAULT txid_current()
+                )
+            """)
+            # Changelogs created before the txid watermark existed
+            cursor.execute(f"ALTER TABLE {CHANGELOG_TABLE} ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT txid_current()")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {CHANGELOG_TABLE}_run_idx ON {CHANGELOG_TABLE} (table_name, run_id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {CHANGELOG_TABLE}_txid_idx ON {CHANGELOG_TABLE} (table_name, txid)")
+            connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error creating changelog table: {e}")
+        connection.rollback()
+
+def read_changelog(connection, table_name, after_txid=0):
+    # Returns the changes to table_name logged since the after_txid watermark, oldest first,
+    # and the watermark to pass next time. Each change carries the id of the transaction
+    # that wrote it, and reads stop below the oldest transaction still running, so a run
+    # that started earlier but commits later is picked up by the next read, not skipped.
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+            watermark = cursor.fetchone()[0]
+            cursor.execute(f"""
+                SELECT run_id, row_key, column_name, old_value, new_value, changed_at FROM {CHANGELOG_TABLE}
+                WHERE table_name = %s AND txid >= %s AND txid < %s ORDER BY txid, change_id
+            """, (table_name, after_txid, watermark))
+            changes = cursor.fetchall()
+        connection.commit()
+        return changes, watermark
+    except psycopg2.Error as e:
+        print(f"Error reading changelog: {e}")
+        connection.rollback()
+        return [], after_txid
+
+# Function to update the changed rows; with changelog_run_id the old and new value of every
+# changed column is collected from the updates and inserted into CHANGELOG_TABLE in one go
+# before the commit, so the log and the updates land together or not at all
+def update_data_in_postgres(connection, table_name, columns, data, primary_key, changelog_run_id=None, run_timestamp=None):
+    # Every row gets the same ingestion_timestamp, run_timestamp (default now)
+    run_timestamp = run_timestamp or datetime.now()
+    try:
+        with connection.cursor() as cursor:
+            changes = []
             for row in data:
                 key = row[columns.index(primary_key)]
                 update_set = []
                 update_values = []
+                logged_columns = []
                 
                 for i, col in enumerate(columns):
                     if col != primary_key and col != 'ingestion_timestamp':
                         update_set.append(f'"{col}" = %s')
                         update_values.append(row[i])
+                        logged_columns.append(col)
 
                 if update_set:
                     update_sql = f'UPDATE {table_name} SET {", ".join(update_set)}, ingestion_timestamp = %s WHERE {primary_key} = %s'
-                    cursor.execute(update_sql, update_values + [datetime.now(), key])
-               
+                    if changelog_run_id is None:
+                        cursor.execute(update_sql, update_values + [run_timestamp, key])
+                        continue
+
+                    # The subquery reads the row as it was before this statement, RETURNING the row after it
+                    update_sql = (f'UPDATE {table_name} AS t SET {", ".join(update_set)}, ingestion_timestamp = %s '
+                                  f'FROM (SELECT * FROM {table_name} WHERE {primary_key} = %s FOR UPDATE) AS old '
+                                  f'WHERE t.{primary_key} = old.{primary_key} RETURNING ' +
+                                  ', '.join([f'old."{col}"::text, t."{col}"::text' for col in logged_columns]))
+                    cursor.execute(update_sql, update_values + [run_timestamp, key])
+                    for returned in cursor.fetchall():
+                        for col, old_value, new_value in zip(logged_columns, returned[0::2], returned[1::2]):
+                            if old_value != new_value:
+                                changes.append((changelog_run_id, table_name, str(key), col, old_value, new_value))
+
+            if changes:
+                extras.execute_values(cursor, f"INSERT INTO {CHANGELOG_TABLE} (run_id, table_name, row_key, column_name, old_value, new_value) VALUES %s",
+                                      changes, page_size=1000)
             connection.commit()
             print("Data updated successfully.")
     except psycopg2.Error as e:
         print(f"Error updating data: {e}")
         connection.rollback()
 
-# Function to update Excel with the ingestion timestamp
-def update_excel_with_timestamp(file_path, updated_rows):
-    workbook = openpyxl.load_workbook(file_path)
+# Function to record the ingestion timestamp of the updated rows
+def update_excel_with_timestamp(file_path, updated_rows, workbook=None, write_back='xlsx', connection=None, run_timestamp=None):
+    # write_back is 'xlsx' to stamp the rows in the workbook itself, 'sidecar' to append the
+    # row-to-timestamp mapping to a CSV next to it, or 'audit_table' to insert it into
+    # INGESTION_AUDIT_TABLE through connection. A writable workbook that is already
+    # loaded can be passed in so it isn't read again. Pass the run_timestamp the rows were
+    # stamped with in the database so both sides agree; it defaults to now.
+    run_timestamp = run_timestamp or datetime.now()
+    sheet_rows = [row_idx + 2 for row_idx in updated_rows]
+
+    if write_back == 'sidecar':
+        write_timestamp_sidecar(file_path, sheet_rows, run_timestamp)
+        return
+    if write_back == 'audit_table':
+        write_timestamp_audit(connection, file_path, sheet_rows, run_timestamp)
+        return
+
+    if workbook is None or getattr(workbook, 'read_only', False):
+        workbook = openpyxl.load_workbook(file_path)
     sheet = workbook.active
     timestamp_header = "Ingestion Timestamp"
-    timestamp_column = Nonex
+    timestamp_column = None
 
     # Find or create the timestamp column
-    for col in range(1, sheet.max_column + 1):
-        if sheet.cell(row=1, column=col).value == timestamp_header:
-            timestamp_column = col
+    for cell in sheet[1]:
+        if cell.value == timestamp_header:
+            timestamp_column = cell.column
             break
 
     if timestamp_column is None:
         timestamp_column = sheet.max_column + 1
         sheet.cell(row=1, column=timestamp_column).value = timestamp_header
 
-    # Update the timestamp for only the rows that were updated
-    for row_idx in updated_rows:
-        sheet.cell(row=row_idx + 2, column=timestamp_column).value = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Update timestamp for only changed rows, all with the run's timestamp
+    timestamp_value = run_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    for sheet_row in sheet_rows:
+        sheet.cell(row=sheet_row, column=timestamp_column).value = timestamp_value
 
     workbook.save(file_path)
 
-# Main function to load Excel data into PostgreSQL
-def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key):
+def write_timestamp_sidecar(file_path, sheet_rows, run_timestamp):
+    sidecar_path = f"{file_path}.ingestion.csv"
+    new_file = not os.path.exists(sidecar_path)
+    timestamp_value = run_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    with open(sidecar_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['sheet_row', 'ingestion_timestamp'])
+        writer.writerows([(sheet_row, timestamp_value) for sheet_row in sheet_rows])
+
+def write_timestamp_audit(connection, file_path, sheet_rows, run_timestamp):
     try:
-        wb = openpyxl.load_workbook(excel_file_path)
-        ws = wb.active
-        print("Excel file read successfully.")
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {INGESTION_AUDIT_TABLE} (source TEXT, sheet_row INTEGER, ingested_at TIMESTAMP)")
+            extras.execute_values(cursor, f"INSERT INTO {INGESTION_AUDIT_TABLE} (source, sheet_row, ingested_at) VALUES %s",
+                                  [(file_path, sheet_row, run_timestamp) for sheet_row in sheet_rows])
+            connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error writing ingestion audit rows: {e}")
+        connection.rollback()
 
-        columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
-        data = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            row_data = [cell if isinstance(cell, (int, float, bool, datetime)) else str(cell) for cell in row]
-            data.append(row_data)
+# Function to stream typed rows from the active sheet in read-only mode
+def read_excel_rows(excel_file_path):
+    # The returned generator yields one row at a time and closes the workbook once exhausted
+    wb = openpyxl.load_workbook(excel_file_path, read_only=True)
+    ws = wb.active
+    columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
 
-        connection = create_postgres_connection(db_params)
-       
-        if connection:
+    def typed_rows():
+        try:
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                # Empty cells stay None so they reach COPY as NULL, not as the text 'None'
+                yield [cell if cell is None or isinstance(cell, (int, float, bool, datetime)) else str(cell) for cell in row]
+        finally:
+            wb.close()
+
+    return columns, typed_rows()
+
+# Main function to load Excel data into PostgreSQL
+def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key, server_diff=True, statement_timeout=None, columnar=True,
+                                  write_back='xlsx', stream_existing=True, fetch_itersize=FETCH_ITERSIZE, changelog=False):
+    # Without server_diff, stream_existing compares the sheet against per-key hashes of the
+    # compared columns streamed from the table instead of loading every stored row.
+    # With changelog, the changed values are logged to CHANGELOG_TABLE under one run id per
+    # call, which is returned to label them; consumers follow the log with read_changelog.
+    run_id = new_run_id() if changelog else None
+    try:
+        columns, rows = read_excel_rows(excel_file_path)
+        print("Excel file opened for streaming.")
+
+        with postgres_session(db_params, statement_timeout) as connection:
             if table_exists(connection, table_name):
-                print(f"Table '{table_name}' already exists. Fetching existing data...")
-                existing_data, existing_columns = fetch_existing_data(connection, table_name, primary_key)
-               
-                rows_to_update = []
-                updated_rows = []
-
-                for idx, row in enumerate(data):
-                    key = row[columns.index(primary_key)]
-                    if key in existing_data:
-                        existing_row = existing_data[key]
-                        if any(str(row[columns.index(col)]) != str(existing_row[existing_columns.index(col)]) for col in columns if col != 'ingestion_timestamp'):
-                            rows_to_update.append(row)
-                            updated_rows.append(idx)
+                if server_diff:
+                    print(f"Table '{table_name}' already exists. Computing changed rows on the server...")
+                    changed_rows, _ = fetch_changed_rows(connection, table_name, columns, rows, primary_key, return_rows=True)
+                    updated_rows = [idx for idx, _ in changed_rows]
+                    rows_to_update = [row for _, row in changed_rows]
+                elif stream_existing:
+                    print(f"Table '{table_name}' already exists. Streaming existing row hashes...")
+                    compare_columns = [col for col in columns if col != primary_key and col != 'ingestion_timestamp']
+                    existing_hashes = fetch_existing_hashes(connection, table_name, primary_key, compare_columns, fetch_itersize)
+                    updated_rows, rows_to_update = find_changed_rows_by_hash(columns, rows, existing_hashes, primary_key)
+                else:
+                    print(f"Table '{table_name}' already exists. Fetching existing data...")
+                    existing_data, existing_columns = fetch_existing_data(connection, table_name, primary_key, fetch_itersize)
+
+                    if columnar and pd is not None:
+                        updated_rows, rows_to_update = find_changed_rows_columnar(columns, list(rows), existing_data, existing_columns, primary_key)
+                    else:
+                        rows_to_update = []
+                        updated_rows = []
+
+                        for idx, row in enumerate(rows):
+                            key = row[columns.index(primary_key)]
+                            if key in existing_data:
+                                existing_row = existing_data[key]
+                                if any(str(row[columns.index(col)]) != str(existing_row[existing_columns.index(col)]) for col in columns if col != 'ingestion_timestamp'):
+                                    rows_to_update.append(row)
+                                    updated_rows.append(idx)
 
                 # Update existing rows in the database
                 if rows_to_update:
-                    update_data_in_postgres(connection, table_name, columns, rows_to_update, primary_key)
-                    update_excel_with_timestamp(excel_file_path, updated_rows)
+                    if changelog:
+                        ensure_changelog_table(connection)
+                    run_timestamp = datetime.now()
+                    update_data_in_postgres(connection, table_name, columns, rows_to_update, primary_key, changelog_run_id=run_id,
+                                            run_timestamp=run_timestamp)
+                    update_excel_with_timestamp(excel_file_path, updated_rows, write_back=write_back, connection=connection,
+                                                run_timestamp=run_timestamp)
        
             else:
                 print(f"Table '{table_name}' does not exist. Creating and inserting data.")
                 # Create table and insert data logic here
 
-            connection.close()
-            print("PostgreSQL Database connection closed.")
+        print("PostgreSQL Database connection returned to the pool.")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+    return run_id
 
 # Define the database parameters, table name, and Excel file path
 db_params = {
@@ -155,6 +524,7 @@ primary_key = 'city'
 
 # Load Excel data into PostgreSQL
 load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key)
+close_connection_pools()
 
 
 # In[ ]:
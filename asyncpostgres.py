@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Asyncio variant of newpostgres.load_excel_data_into_postgres on asyncpg, for services
+# that run many syncs concurrently in one process. Workbooks are parsed in an executor
+# thread that feeds row chunks through a bounded queue to the coroutine writing them, so
+# a slow database stalls the parser instead of letting parsed rows pile up in memory.
+
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+import asyncpg
+
+import newpostgres
+from newpostgres import COPY_CHUNK_SIZE, TYPE_SAMPLE_ROWS
+
+# Parsed chunks waiting to be written, per load
+ASYNC_QUEUE_DEPTH = 4
+
+# asyncpg pools belong to the event loop that created them, so they are kept per loop
+_async_pools = {}
+_table_locks = defaultdict(asyncio.Lock)
+_end_of_rows = object()
+
+async def get_async_pool(db_params, min_connections=newpostgres.POOL_MIN_CONNECTIONS, max_connections=newpostgres.POOL_MAX_CONNECTIONS):
+    # The pool is created by a task so concurrent first callers all wait on the same one
+    pool_key = (id(asyncio.get_running_loop()), tuple(sorted(db_params.items())))
+    if pool_key not in _async_pools:
+        async def create_pool():
+            connection_pool = await asyncpg.create_pool(
+                min_size=min_connections,
+                max_size=max_connections,
+                database=db_params['database'],
+                user=db_params['user'],
+                password=db_params['password'],
+                host=db_params['host'],
+                port=int(db_params['port'])
+            )
+            print("PostgreSQL async connection pool created successfully.")
+            return connection_pool
+
+        _async_pools[pool_key] = asyncio.ensure_future(create_pool())
+    return await _async_pools[pool_key]
+
+async def close_async_connection_pools():
+    loop_id = id(asyncio.get_running_loop())
+    for pool_key in [key for key in _async_pools if key[0] == loop_id]:
+        connection_pool = await _async_pools.pop(pool_key)
+        await connection_pool.close()
+
+@asynccontextmanager
+async def async_postgres_session(db_params, statement_timeout=None, metrics=None):
+    # acquire() waits for a free connection once the pool is exhausted, and the pool
+    # resets the session (RESET ALL) when it is released
+    with newpostgres.timed_phase(metrics, 'connect'):
+        connection_pool = await get_async_pool(db_params)
+        connection = await connection_pool.acquire()
+    query_logger = None
+    try:
+        if metrics is not None:
+            query_logger = lambda logged_query: count_statement(metrics, logged_query)
+            connection.add_query_logger(query_logger)
+        if statement_timeout is not None:
+            await connection.execute(f"SET statement_timeout = {int(statement_timeout)}")
+        yield connection
+    finally:
+        if query_logger is not None:
+            connection.remove_query_logger(query_logger)
+        await connection_pool.release(connection)
+
+def count_statement(metrics, logged_query):
+    metrics['counters']['statements'] += 1
+    metrics['counters']['bytes_sent'] += len(logged_query.query)
+
+async def table_exists(connection, table_name):
+    return await connection.fetchval("SELECT to_regclass($1) IS NOT NULL", table_name)
+
+async def get_existing_columns(connection, table_name):
+    records = await connection.fetch(
+        "SELECT attname FROM pg_attribute WHERE attrelid = to_regclass($1) AND attnum > 0 AND NOT attisdropped ORDER BY attnum",
+        table_name)
+    return [record['attname'] for record in records]
+
+async def create_table(connection, table_name, columns, column_types=None, primary_key=None):
+    try:
+        column_types = column_types or {}
+        columns_def = ', '.join([f'"{col}" {column_types.get(col, "VARCHAR(255)")}' for col in columns])
+        primary_key_def = f', PRIMARY KEY ("{primary_key}")' if primary_key else ''
+        await connection.execute(f"CREATE TABLE {table_name} ({columns_def}{primary_key_def})")
+        print(f"Table '{table_name}' created successfully.")
+    except asyncpg.PostgresError as e:
+        print(f"Error creating table: {e}")
+
+async def key_is_unique(connection, table_name, key_column):
+    # True if key_column on its own is the primary key or has a valid unique index
+    return await connection.fetchval("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass($1) AND i.indisunique AND i.indisvalid
+              AND i.indnatts = 1 AND i.indpred IS NULL AND a.attname = $2
+        )
+    """, table_name, key_column)
+
+async def ensure_key_constraint(connection, table_name, key_column):
+    # Async counterpart of newpostgres.ensure_key_constraint. Outside connection.transaction()
+    # asyncpg runs each statement on its own, so the concurrent index build needs no autocommit switch.
+    try:
+        if await key_is_unique(connection, table_name, key_column):
+            return True
+        duplicates = await connection.fetch(
+            f'SELECT "{key_column}", count(*) FROM {table_name} GROUP BY 1 HAVING count(*) > 1 OR "{key_column}" IS NULL LIMIT 5')
+        if duplicates:
+            print(f"Cannot add a key on '{table_name}.{key_column}', it has duplicate or NULL values: {[tuple(row) for row in duplicates]}")
+            return False
+
+        # An interrupted concurrent build leaves an invalid index behind
+        index_name = f"{table_name}_{key_column}_key"
+        await connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+        await connection.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {index_name} ON {table_name} ("{key_column}")')
+
+        if await connection.fetchval("SELECT NOT EXISTS (SELECT 1 FROM pg_index WHERE indrelid = to_regclass($1) AND indisprimary)", table_name):
+            await connection.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_pkey PRIMARY KEY USING INDEX {index_name}")
+            print(f"Added primary key ({key_column}) to table '{table_name}'.")
+        else:
+            print(f"Added unique index on '{table_name}.{key_column}'.")
+        return True
+    except asyncpg.PostgresError as e:
+        print(f"Error adding key to table: {e}")
+        return False
+
+async def alter_table(connection, table_name, columns, column_types=None):
+    # Adds every missing column in one statement; returns the columns that were added
+    try:
+        existing_columns = {col.lower() for col in await get_existing_columns(connection, table_name)}
+        column_types = column_types or {}
+        added_columns = [column for column in columns if column.lower() not in existing_columns]
+        if added_columns:
+            add_columns = ', '.join([f'ADD COLUMN IF NOT EXISTS "{column}" {column_types.get(column, "VARCHAR(255)")}' for column in added_columns])
+            await connection.execute(f"ALTER TABLE {table_name} {add_columns}")
+            for column in added_columns:
+                print(f"Altered table '{table_name}' to add column '{column}'.")
+        return added_columns
+    except asyncpg.PostgresError as e:
+        print(f"Error altering table: {e}")
+        return []
+
+async def widen_column_types(connection, table_names, columns, column_types, chunk):
+    # Chunk-at-a-time counterpart of newpostgres.widen_column_types, run before the chunk is copied
+    for i, col in [(i, col) for i, col in enumerate(columns) if col in column_types]:
+        wider_type = column_types[col]
+        for row in chunk:
+            wider_type = newpostgres.promote_type(wider_type, newpostgres.infer_value_type(row[i]))
+        if wider_type != column_types[col]:
+            for table_name in table_names:
+                await connection.execute(f'ALTER TABLE {table_name} ALTER COLUMN "{col}" TYPE {wider_type} USING "{col}"::{wider_type}')
+            print(f"Widened column '{col}' from {column_types[col]} to {wider_type}.")
+            column_types[col] = wider_type
+
+async def copy_chunk(connection, table_name, columns, chunk, metrics=None):
+    # Same CSV encoding as the psycopg2 COPY path, so values are cast by the server
+    data = newpostgres.csv_buffer(chunk).getvalue().encode('utf-8')
+
+    async def source():
+        yield data
+
+    await connection.copy_to_table(table_name.lower(), source=source(), columns=columns, format='csv', null='\\N')
+    if metrics is not None:
+        metrics['counters']['bytes_sent'] += len(data)
+
+def start_parsing(rows, chunk_size, queue, stop, executor=None):
+    # Runs the blocking sheet iteration in an executor thread. Each chunk is handed to the
+    # event loop and the thread waits while the queue is full; a failure is queued in
+    # place of the next chunk. Returns (future, parse_seconds) where parse_seconds is a
+    # one-item list filled in by the thread.
+    loop = asyncio.get_running_loop()
+    parse_seconds = [0.0]
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce():
+        chunks = newpostgres.chunked(rows, chunk_size)
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                parse_seconds[0] += time.perf_counter() - start
+                if chunk is None:
+                    break
+                put(chunk)
+        except Exception as e:
+            put(e)
+        finally:
+            chunks.close()
+            put(_end_of_rows)
+
+    return loop.run_in_executor(executor, produce), parse_seconds
+
+async def parsed_chunks(queue):
+    while True:
+        item = await queue.get()
+        if item is _end_of_rows:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+async def stop_parsing(parser, queue, stop):
+    # Unblocks a parser thread still waiting on a full queue and waits for it to finish
+    stop.set()
+    while not parser.done():
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.sleep(0.01)
+    await parser
+
+async def write_chunks(connection, table_name, columns, chunks, primary_key, exists, column_types=None, metrics=None):
+    # Existing tables are merged through a temp staging table, new ones are filled with
+    # COPY directly; either way in one transaction. Returns the counts written.
+    stage_table = f"{table_name}_stage"
+    target_table = stage_table if exists else table_name
+    widened_tables = [table_name, stage_table] if exists else [table_name]
+    written_rows = 0
+    async with connection.transaction():
+        if exists:
+            await connection.execute(newpostgres.stage_table_sql(table_name, stage_table))
+        async for chunk in chunks:
+            if column_types:
+                await widen_column_types(connection, widened_tables, columns, column_types, chunk)
+            await copy_chunk(connection, target_table, columns, chunk, metrics)
+            written_rows += len(chunk)
+            if metrics is not None:
+                metrics['counters']['rows_written'] += len(chunk)
+        if not exists:
+            return {'inserted': written_rows}
+        inserted, updated = await connection.fetchrow(newpostgres.merge_sql(table_name, stage_table, columns, primary_key))
+        return {'inserted': inserted, 'updated': updated, 'unchanged': written_rows - inserted - updated}
+
+async def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key, chunk_size=COPY_CHUNK_SIZE,
+                                        statement_timeout=None, infer_types=True, column_type_overrides=None,
+                                        queue_depth=ASYNC_QUEUE_DEPTH, parse_executor=None, metrics_sinks=None):
+    # Async counterpart of newpostgres.load_excel_data_into_postgres with merge=True. Loads
+    # into the same table are serialized so CREATE/ALTER don't race. parse_executor
+    # defaults to the loop's default thread pool. excel_file_path may also be a csv/tsv file,
+    # read with newpostgres.read_source_rows; its rows are parsed, there is no COPY pass-through.
+    # Returns the run's metrics.
+    loop = asyncio.get_running_loop()
+    metrics = newpostgres.new_sync_metrics(excel_file_path, table_name)
+    start = time.perf_counter()
+    queue = asyncio.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    parser = None
+    try:
+        with newpostgres.timed_phase(metrics, 'open'):
+            columns, rows = await loop.run_in_executor(parse_executor, newpostgres.read_source_rows, excel_file_path)
+        print("Excel file opened for streaming.")
+        print("Columns in the Excel file:", columns)
+
+        async with _table_locks[table_name.lower()], async_postgres_session(db_params, statement_timeout, metrics) as connection:
+            with newpostgres.timed_phase(metrics, 'schema'):
+                column_types = None
+                if infer_types:
+                    column_types, rows = await loop.run_in_executor(parse_executor, newpostgres.infer_column_types, columns, rows,
+                                                                    TYPE_SAMPLE_ROWS, column_type_overrides)
+                    inferred_types = {col: col_type for col, col_type in column_types.items() if col not in (column_type_overrides or {})}
+
+                exists = await table_exists(connection, table_name)
+                if exists:
+                    print(f"Table '{table_name}' already exists. Checking and updating schema if needed...")
+                    added_columns = await alter_table(connection, table_name, columns, column_types)
+                    await ensure_key_constraint(connection, table_name, primary_key)
+                    if column_types:
+                        inferred_types = {col: inferred_types[col] for col in added_columns if col in inferred_types}
+                else:
+                    print(f"Table '{table_name}' does not exist. Creating and inserting data.")
+                    await create_table(connection, table_name, columns, column_types, primary_key)
+
+            # Parsing and writing overlap from here on, so the write phase includes time
+            # spent waiting for the parser
+            parser, parse_seconds = start_parsing(rows, chunk_size, queue, stop, parse_executor)
+            with newpostgres.timed_phase(metrics, 'write'):
+                counts = await write_chunks(connection, table_name, columns, parsed_chunks(queue), primary_key, exists,
+                                            inferred_types if column_types else None, metrics)
+            await parser
+            metrics['phases']['parse'] += parse_seconds[0]
+            metrics['counters']['rows_read'] = metrics['counters']['rows_written']
+            metrics['counters']['rows_changed'] = counts.get('inserted', 0) + counts.get('updated', 0)
+            print(f"Data written successfully: {counts}")
+
+        print("PostgreSQL Database connection returned to the pool.")
+
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+        metrics['error'] = str(e)
+    except asyncpg.PostgresError as e:
+        print(f"Error writing data: {e}")
+        metrics['error'] = str(e)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        metrics['error'] = str(e)
+    finally:
+        if parser is not None and not parser.done():
+            await stop_parsing(parser, queue, stop)
+        metrics['seconds'] = time.perf_counter() - start
+        newpostgres.emit_sync_metrics(metrics, metrics_sinks)
+    return metrics
+
+async def load_excel_files_concurrently(db_params, loads, max_concurrent_loads=newpostgres.POOL_MAX_CONNECTIONS, **options):
+    # loads is a list of (table_name, excel_file_path, primary_key); at most
+    # max_concurrent_loads run at once. Returns their metrics in the same order.
+    slots = asyncio.Semaphore(max_concurrent_loads)
+
+    async def bounded_load(table_name, excel_file_path, primary_key):
+        async with slots:
+            return await load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key, **options)
+
+    return await asyncio.gather(*[bounded_load(*load) for load in loads])
+
+if __name__ == '__main__':
+    db_params = {
+        'database': 'postgres',
+        'user': 'postgres',
+        'password': '1234',
+        'host': 'localhost',
+        'port': '5432'
+    }
+
+    async def main():
+        try:
+            await load_excel_data_into_postgres(db_params, 'weather_data', r'C:\Users\Wissen\Downloads\weather_data.xlsx', 'city')
+        finally:
+            await close_async_connection_pools()
+
+    asyncio.run(main())
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Benchmark for the Excel -> PostgreSQL loaders in newpostgres.py.
+#
+# Generates weather_data-style workbooks, starts a throwaway PostgreSQL cluster with
+# initdb/pg_ctl (found on PATH or in $PG_BIN; run as a non-root user), and times
+# load_excel_data_into_postgres for the insert, upsert and merge (diff) paths.
+# Round trips are counted from the cluster's statement log. Results are printed,
+# or written with --output, as JSON so runs can be compared between versions.
+#
+#   python benchmark.py --rows 100000 --columns 20 --change-ratio 0.01 --output bench.json
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from openpyxl import Workbook
+
+import newpostgres
+
+# Dropped and recreated by every variant, so never the name of a real table
+TABLE_NAME = 'excel_bench_weather_data'
+PRIMARY_KEY = 'city'
+
+def generate_workbook(file_path, rows, columns, seed=0, change_ratio=0.0, new_ratio=0.0):
+    # The same seed gives the same base sheet; change_ratio of its rows then get a new
+    # temperature and new_ratio * rows extra cities are appended
+    rng = random.Random(seed)
+    changed = random.Random(seed + 1)
+    reading_columns = [f"Reading {i}" for i in range(max(columns - 4, 0))]
+    start = datetime.datetime(2024, 1, 1)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('weather_data')
+    ws.append(['City', 'Temperature', 'Humidity', 'Recorded At'] + reading_columns)
+    for i in range(rows + int(rows * new_ratio)):
+        temperature = round(rng.uniform(-20, 45), 1)
+        row = [f"city_{i:08d}", temperature, rng.randint(0, 100), start + datetime.timedelta(minutes=i)]
+        row += [round(rng.uniform(0, 1000), 3) for _ in reading_columns]
+        if i < rows and changed.random() < change_ratio:
+            row[1] = round(temperature + 1, 1)
+        ws.append(row)
+    wb.save(file_path)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def pg_binary(name):
+    pg_bin = os.environ.get('PG_BIN')
+    path = os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise RuntimeError(f"'{name}' not found; put the PostgreSQL binaries on PATH or set PG_BIN.")
+    return path
+
+@contextlib.contextmanager
+def throwaway_cluster(work_dir):
+    # Every statement is logged so round trips can be counted per run
+    data_dir = os.path.join(work_dir, 'pgdata')
+    log_path = os.path.join(work_dir, 'postgres.log')
+    port = free_port()
+    subprocess.run([pg_binary('initdb'), '-D', data_dir, '-A', 'trust', '-U', 'postgres'], check=True, stdout=subprocess.DEVNULL)
+    options = f"-p {port} -c listen_addresses=localhost -c unix_socket_directories='{work_dir}' -c log_statement=all -c fsync=off"
+    subprocess.run([pg_binary('pg_ctl'), '-D', data_dir, '-o', options, '-l', log_path, '-w', 'start'], check=True, stdout=subprocess.DEVNULL)
+    try:
+        db_params = {'database': 'postgres', 'user': 'postgres', 'password': '', 'host': 'localhost', 'port': str(port)}
+        yield db_params, log_path
+    finally:
+        subprocess.run([pg_binary('pg_ctl'), '-D', data_dir, '-m', 'fast', '-w', 'stop'], check=True, stdout=subprocess.DEVNULL)
+
+def count_statements(log_path, offset):
+    if log_path is None:
+        return None, offset
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        text = f.read()
+        new_offset = f.tell()
+    return sum(text.count(marker) for marker in (b'LOG:  statement: ', b'LOG:  execute ')), new_offset
+
+def run_setup_sql(db_params, statements):
+    connection = newpostgres.create_postgres_connection(db_params)
+    try:
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+        connection.commit()
+    finally:
+        connection.close()
+
+def table_row_count(db_params):
+    connection = newpostgres.create_postgres_connection(db_params)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {TABLE_NAME}")
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+def timed_load(db_params, excel_file_path, load_options):
+    # Runs in a fresh process so peak RSS belongs to this load alone
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        metrics = newpostgres.load_excel_data_into_postgres(db_params, TABLE_NAME, excel_file_path, PRIMARY_KEY, **load_options)
+        seconds = time.perf_counter() - start
+        newpostgres.close_connection_pools()
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss_kb //= 1024
+    return seconds, peak_rss_kb, metrics
+
+def run_variant(db_params, log_path, name, setup_file, excel_file_path, rows, load_options):
+    # setup_file, when given, is loaded first (untimed) so the variant runs against an existing table
+    run_setup_sql(db_params, [f"DROP TABLE IF EXISTS {TABLE_NAME}"])
+    if setup_file:
+        with multiprocessing.get_context('spawn').Pool(1) as worker:
+            worker.apply(timed_load, (db_params, setup_file, {}))
+
+    offset = os.path.getsize(log_path) if log_path else 0
+    with multiprocessing.get_context('spawn').Pool(1) as worker:
+        seconds, peak_rss_kb, metrics = worker.apply(timed_load, (db_params, excel_file_path, load_options))
+    round_trips, _ = count_statements(log_path, offset)
+
+    return {
+        'variant': name,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+        'peak_rss_kb': peak_rss_kb,
+        'round_trips': round_trips,
+        'statements': metrics['counters']['statements'],
+        'bytes_sent': metrics['counters']['bytes_sent'],
+        'rows_changed': metrics['counters']['rows_changed'],
+        'error': metrics['error'],
+        'phases': {phase: round(seconds, 4) for phase, seconds in metrics['phases'].items()},
+        'table_rows': table_row_count(db_params),
+    }
+
+def run_benchmark(args, db_params, log_path, work_dir):
+    phases = {}
+    base_path = os.path.join(work_dir, 'base.xlsx')
+    changed_path = os.path.join(work_dir, 'changed.xlsx')
+
+    start = time.perf_counter()
+    generate_workbook(base_path, args.rows, args.columns, args.seed)
+    generate_workbook(changed_path, args.rows, args.columns, args.seed, args.change_ratio, args.new_ratio)
+    phases['generate_workbooks'] = round(time.perf_counter() - start, 4)
+
+    changed_rows = args.rows + int(args.rows * args.new_ratio)
+    variants = [
+        ('insert', None, base_path, args.rows, {}),
+        ('upsert', base_path, changed_path, changed_rows, {'merge': False}),
+        ('merge', base_path, changed_path, changed_rows, {'merge': True}),
+    ]
+    if args.pipeline:
+        variants = [(name, setup_file, path, rows, dict(options, pipeline=True)) for name, setup_file, path, rows, options in variants]
+    results = []
+    for name, setup_file, excel_file_path, rows, load_options in variants:
+        if args.variants and name not in args.variants:
+            continue
+        start = time.perf_counter()
+        results.append(run_variant(db_params, log_path, name, setup_file, excel_file_path, rows, load_options))
+        phases[f"variant_{name}"] = round(time.perf_counter() - start, 4)
+
+    return {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'version': git_version(),
+        'parameters': {'rows': args.rows, 'columns': args.columns, 'change_ratio': args.change_ratio,
+                       'new_ratio': args.new_ratio, 'seed': args.seed, 'pipeline': args.pipeline},
+        'phases': phases,
+        'results': results,
+    }
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the Excel to PostgreSQL loaders.")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--change-ratio', type=float, default=0.01)
+    parser.add_argument('--new-ratio', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipeline', action='store_true', help="parse in a reader thread overlapping the writes")
+    parser.add_argument('--variants', nargs='*', choices=['insert', 'upsert', 'merge'])
+    parser.add_argument('--port', help="use an existing server on localhost instead of a throwaway cluster (round trips are not counted)")
+    parser.add_argument('--database', default='postgres')
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix='excel_pg_bench_') as work_dir:
+        if args.port:
+            db_params = {'database': args.database, 'user': args.user, 'password': args.password, 'host': 'localhost', 'port': args.port}
+            report = run_benchmark(args, db_params, None, work_dir)
+        else:
+            with throwaway_cluster(work_dir) as (db_params, log_path):
+                report = run_benchmark(args, db_params, log_path, work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -4,10 +4,60 @@
 # In[22]:
 
 
+import csv
+import glob
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, count, islice
 import psycopg2
+from psycopg2 import errors, extensions, extras, pool
 from openpyxl import load_workbook
 import datetime
 
+# pyarrow is optional; without it the Parquet export is skipped
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Rows per COPY buffer / INSERT page when bulk loading a new table
+COPY_CHUNK_SIZE = 10000
+
+# Rows sampled to infer column types before a table or column is created
+TYPE_SAMPLE_ROWS = 1000
+
+# Progress of loads run with commit_every, saved in the same transaction as each batch so
+# a rerun of the same file resumes after the last committed batch
+CHECKPOINT_TABLE = 'excel_sync_checkpoints'
+
+# Rows refused by the database in loads run with reject_rows, with the error for each
+REJECTS_TABLE = 'excel_sync_rejects'
+
+# Secondary indexes built after each load, by table name, e.g. {'weather_data': [['recorded_at']]}
+SECONDARY_INDEXES = {}
+
+# Rows per server-side cursor fetch and per Parquet file in the post-load export
+EXPORT_BATCH_ROWS = 50000
+
+# Chunks the reader thread may parse ahead of the writer in pipelined loads
+PIPELINE_QUEUE_DEPTH = 4
+
+# Local record of each workbook and its row hashes as of the last successful sync
+SYNC_STATE_PATH = 'excel_sync_state.sqlite3'
+
 def create_postgres_connection(db_params):
     try:
         connection = psycopg2.connect(
@@ -23,43 +73,534 @@ def create_postgres_connection(db_params):
         print(f"Error connecting to PostgreSQL Database: {e}")
         return None
 
-def table_exists(connection, table_name):
+# Every load records its own time per phase and a few counters in a metrics dict. Phases
+# nest: a phase is charged only for time not spent in phases timed inside it, so rows
+# parsed lazily while the write is running count as parse, not write.
+SYNC_PHASES = ('open', 'parse', 'connect', 'fetch_existing', 'diff', 'schema', 'write', 'commit', 'export')
+SYNC_COUNTERS = ('rows_read', 'rows_changed', 'rows_written', 'rows_rejected', 'statements', 'bytes_sent')
+metrics_logger = logging.getLogger('excel_sync.metrics')
+
+def new_sync_metrics(source, table_name):
+    return {
+        'source': source,
+        'table': table_name,
+        'started_at': time.time(),
+        'seconds': 0.0,
+        'error': None,
+        'export_error': None,
+        'phases': dict.fromkeys(SYNC_PHASES, 0.0),
+        'counters': dict.fromkeys(SYNC_COUNTERS, 0),
+    }
+
+@contextmanager
+def timed_phase(metrics, phase):
+    if metrics is None:
+        yield
+        return
+    phases = metrics['phases']
+    start = time.perf_counter()
+    nested_before = sum(phases.values())
+    try:
+        yield
+    finally:
+        nested = sum(phases.values()) - nested_before
+        phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start - nested
+
+def metered_rows(metrics, rows, phase=None, counter=None):
+    # Passes rows through, charging the time spent producing each one to phase and
+    # counting them in counter
+    if metrics is None:
+        yield from rows
+        return
+    phases = metrics['phases']
+    rows = iter(rows)
+    while True:
+        start = time.perf_counter()
+        nested_before = sum(phases.values())
+        row = next(rows, None)
+        if phase is not None:
+            nested = sum(phases.values()) - nested_before
+            phases[phase] = phases.get(phase, 0.0) + time.perf_counter() - start - nested
+        if row is None:
+            return
+        if counter is not None:
+            metrics['counters'][counter] += 1
+        yield row
+
+def emit_sync_metrics(metrics, metrics_sinks):
+    # A sink is any callable taking the metrics dict, e.g. log_sync_metrics or a
+    # prometheus_textfile_sink; a failing sink never fails the load
+    for sink in metrics_sinks or []:
+        try:
+            sink(metrics)
+        except Exception as e:
+            print(f"Error emitting sync metrics: {e}")
+
+def log_sync_metrics(metrics):
+    metrics_logger.info("sync %s -> %s: %s", metrics['source'], metrics['table'], json.dumps(metrics, default=str),
+                        extra={'sync_metrics': metrics})
+
+def prometheus_textfile_sink(path):
+    # Returns a sink that rewrites path in the Prometheus text format (for node_exporter's
+    # textfile collector) with the latest run of every source/table seen by this process
+    latest_runs = {}
+    lock = threading.Lock()
+
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def sink(metrics):
+        with lock:
+            latest_runs[(metrics['source'], metrics['table'])] = metrics
+            lines = [
+                '# HELP excel_sync_phase_seconds Time spent in each phase of the last sync.',
+                '# TYPE excel_sync_phase_seconds gauge',
+            ]
+            for run in latest_runs.values():
+                labels = f'source="{label(run["source"])}",table="{label(run["table"])}"'
+                lines += [f'excel_sync_phase_seconds{{{labels},phase="{phase}"}} {seconds:.6f}' for phase, seconds in run['phases'].items()]
+            lines += ['# HELP excel_sync_count Rows and statements handled by the last sync.', '# TYPE excel_sync_count gauge']
+            for run in latest_runs.values():
+                labels = f'source="{label(run["source"])}",table="{label(run["table"])}"'
+                lines += [f'excel_sync_count{{{labels},counter="{counter}"}} {value}' for counter, value in run['counters'].items()]
+            lines += ['# HELP excel_sync_last_run Duration, start time and success of the last sync.', '# TYPE excel_sync_last_run gauge']
+            for run in latest_runs.values():
+                labels = f'source="{label(run["source"])}",table="{label(run["table"])}"'
+                lines += [
+                    f'excel_sync_last_run{{{labels},field="seconds"}} {run["seconds"]:.6f}',
+                    f'excel_sync_last_run{{{labels},field="started_at"}} {run["started_at"]:.3f}',
+                    f'excel_sync_last_run{{{labels},field="success"}} {0 if run["error"] else 1}',
+                    f'excel_sync_last_run{{{labels},field="export_success"}} {0 if run["export_error"] else 1}',
+                ]
+            # Written to a temp file and renamed so the collector never reads a partial file
+            with open(f"{path}.tmp", 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(f"{path}.tmp", path)
+
+    return sink
+
+class CountingReader:
+    # File wrapper that adds what COPY reads from it to counters['bytes_sent']
+    def __init__(self, file, counters):
+        self.file = file
+        self.counters = counters
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.counters['bytes_sent'] += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.file.readline(size)
+        self.counters['bytes_sent'] += len(data)
+        return data
+
+@contextmanager
+def schema_errors_invalidate_cache(connection):
+    # Another process may have created or dropped a table, or added a column, since the
+    # schema cache was loaded
+    try:
+        yield
+    except (errors.UndefinedTable, errors.DuplicateTable, errors.UndefinedColumn, errors.DuplicateColumn):
+        invalidate_schema_cache(connection)
+        raise
+
+# Pooled connections are MeteredConnections: while a load has its metrics attached, every
+# statement, the bytes sent with it and the time spent committing are recorded
+class MeteredCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        with schema_errors_invalidate_cache(self.connection):
+            result = super().execute(query, vars)
+        metrics = self.connection.metrics
+        if metrics is not None:
+            metrics['counters']['statements'] += 1
+            metrics['counters']['bytes_sent'] += len(self.query or b'')
+        return result
+
+    def executemany(self, query, vars_list):
+        metrics = self.connection.metrics
+        if metrics is None:
+            return super().executemany(query, vars_list)
+        # Rows are counted as psycopg2 iterates them, so streamed input stays streamed
+        executed = count()
+        result = super().executemany(query, (vars for vars, _ in zip(vars_list, executed)))
+        statements = next(executed)
+        # Only the last statement is kept, so bytes are estimated from it
+        metrics['counters']['statements'] += statements
+        metrics['counters']['bytes_sent'] += len(self.query or b'') * statements
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics = self.connection.metrics
+        with schema_errors_invalidate_cache(self.connection):
+            if metrics is None:
+                return super().copy_expert(sql, file, size)
+            metrics['counters']['statements'] += 1
+            metrics['counters']['bytes_sent'] += len(sql)
+            return super().copy_expert(sql, CountingReader(file, metrics['counters']), size)
+
+class MeteredConnection(extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = None
+        self.cursor_factory = MeteredCursor
+
+    def commit(self):
+        with timed_phase(self.metrics, 'commit'):
+            super().commit()
+
+# Connections are pooled per db_params and shared by every load in the process.
+# psycopg2 keeps at most POOL_MIN_CONNECTIONS idle connections between checkouts.
+POOL_MIN_CONNECTIONS = 2
+POOL_MAX_CONNECTIONS = 10
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_params, min_connections=POOL_MIN_CONNECTIONS, max_connections=POOL_MAX_CONNECTIONS):
+    pool_key = tuple(sorted(db_params.items()))
+    with _connection_pools_lock:
+        if pool_key not in _connection_pools:
+            connection_pool = pool.ThreadedConnectionPool(
+                min_connections,
+                max_connections,
+                dbname=db_params['database'],
+                user=db_params['user'],
+                password=db_params['password'],
+                host=db_params['host'],
+                port=db_params['port'],
+                connection_factory=MeteredConnection
+            )
+            # getconn raises once the pool is exhausted, so checkouts wait for a slot first
+            _connection_pools[pool_key] = (connection_pool, threading.BoundedSemaphore(max_connections))
+            print("PostgreSQL connection pool created successfully.")
+        return _connection_pools[pool_key]
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        for connection_pool, _ in _connection_pools.values():
+            connection_pool.closeall()
+        _connection_pools.clear()
+
+def connection_is_healthy(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def postgres_session(db_params, statement_timeout=None, metrics=None):
+    # Check out a pooled connection, replacing it if it has gone stale, and hand it back
+    # with the session reset. statement_timeout is in milliseconds. metrics, if given, is
+    # attached to the connection for the session and the checkout is timed as 'connect'.
+    connection = None
+    with timed_phase(metrics, 'connect'):
+        connection_pool, slots = get_connection_pool(db_params)
+        slots.acquire()
+    try:
+        with timed_phase(metrics, 'connect'):
+            connection = connection_pool.getconn()
+            if not connection_is_healthy(connection):
+                connection_pool.putconn(connection, close=True)
+                connection = connection_pool.getconn()
+            connection.metrics = metrics
+            if statement_timeout is not None:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET statement_timeout = %s", (statement_timeout,))
+                connection.commit()
+        yield connection
+    finally:
+        if connection is not None:
+            connection.metrics = None
+            try:
+                connection.reset()
+            except psycopg2.Error:
+                connection.close()
+            connection_pool.putconn(connection, close=bool(connection.closed))
+        slots.release()
+
+# Table metadata per database (keyed by DSN), preloaded from pg_catalog in one query.
+# Anything that runs DDL must call invalidate_schema_cache afterwards; pooled cursors also
+# drop it when a table turns out missing or already there because of another process's DDL.
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+def load_schema_cache(connection):
     try:
         cursor = connection.cursor()
-        cursor.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s)", (table_name,))
-        table_exists = cursor.fetchone()[0]
+        cursor.execute("""
+            SELECT c.relname, n.nspname, a.attname, format_type(a.atttypid, a.atttypmod), COALESCE(a.attnum = ANY(i.indkey), false)
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+            LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+            WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f') AND n.nspname = ANY(current_schemas(false))
+            ORDER BY array_position(current_schemas(false), n.nspname), c.relname, a.attnum
+        """)
+        catalog_rows = cursor.fetchall()
         cursor.close()
-        return table_exists
     except psycopg2.Error as e:
-        print(f"Error checking if table exists: {e}")
-        return False
+        print(f"Error loading table metadata: {e}")
+        connection.rollback()
+        return {}
 
-def create_table(connection, table_name, columns):
+    # Tables earlier in the search path shadow same-named ones further along
+    schema = {}
+    table_schemas = {}
+    for table_name, schema_name, column_name, column_type, is_primary_key in catalog_rows:
+        if table_schemas.setdefault(table_name, schema_name) != schema_name:
+            continue
+        table = schema.setdefault(table_name, {'columns': {}, 'primary_key': []})
+        table['columns'][column_name] = column_type
+        if is_primary_key:
+            table['primary_key'].append(column_name)
+
+    with _schema_cache_lock:
+        _schema_cache[connection.dsn] = schema
+    return schema
+
+def get_table_schema(connection, table_name):
+    with _schema_cache_lock:
+        schema = _schema_cache.get(connection.dsn)
+    if schema is None:
+        schema = load_schema_cache(connection)
+    return schema.get(table_name.lower())
+
+def invalidate_schema_cache(connection):
+    with _schema_cache_lock:
+        _schema_cache.pop(connection.dsn, None)
+
+def table_exists(connection, table_name):
+    return get_table_schema(connection, table_name) is not None
+
+def create_table(connection, table_name, columns, column_types=None, primary_key=None):
     try:
         cursor = connection.cursor()
-        columns_def = ', '.join([f'"{col}" VARCHAR(255)' for col in columns])
-        create_table_sql = f"CREATE TABLE {table_name} ({columns_def})"
+        column_types = column_types or {}
+        columns_def = ', '.join([f'"{col}" {column_types.get(col, "VARCHAR(255)")}' for col in columns])
+        primary_key_def = f', PRIMARY KEY ("{primary_key}")' if primary_key else ''
+        create_table_sql = f"CREATE TABLE {table_name} ({columns_def}{primary_key_def})"
         cursor.execute(create_table_sql)
         cursor.close()
         connection.commit()
+        invalidate_schema_cache(connection)
         print(f"Table '{table_name}' created successfully.")
     except psycopg2.Error as e:
         print(f"Error creating table: {e}")
+        connection.rollback()
+
+def key_is_unique(connection, table_name, key_column):
+    # True if key_column on its own is the primary key or has a valid unique index
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(%s) AND i.indisunique AND i.indisvalid
+              AND i.indnatts = 1 AND i.indpred IS NULL AND a.attname = %s
+        )
+    """, (table_name, key_column))
+    unique = cursor.fetchone()[0]
+    cursor.close()
+    return unique
 
-def insert_data(connection, table_name, columns, data):
+def ensure_key_constraint(connection, table_name, key_column):
+    # Gives an existing table the key the loaders upsert on: a unique index built
+    # concurrently, attached as the primary key unless the table already has another one.
+    # Nothing is changed if the stored rows have duplicate or NULL keys.
+    try:
+        if key_is_unique(connection, table_name, key_column):
+            return True
+        cursor = connection.cursor()
+        cursor.execute(f'SELECT "{key_column}", count(*) FROM {table_name} GROUP BY 1 HAVING count(*) > 1 OR "{key_column}" IS NULL LIMIT 5')
+        duplicates = cursor.fetchall()
+        connection.commit()
+        if duplicates:
+            print(f"Cannot add a key on '{table_name}.{key_column}', it has duplicate or NULL values: {duplicates}")
+            return False
+
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        index_name = f"{table_name}_{key_column}_key"
+        connection.autocommit = True
+        try:
+            # An interrupted concurrent build leaves an invalid index behind
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+            cursor.execute(f'CREATE UNIQUE INDEX CONCURRENTLY {index_name} ON {table_name} ("{key_column}")')
+        finally:
+            connection.autocommit = False
+
+        table = get_table_schema(connection, table_name)
+        if table and not table['primary_key']:
+            cursor.execute(f"ALTER TABLE {table_name} ADD CONSTRAINT {table_name}_pkey PRIMARY KEY USING INDEX {index_name}")
+            connection.commit()
+            print(f"Added primary key ({key_column}) to table '{table_name}'.")
+        else:
+            print(f"Added unique index on '{table_name}.{key_column}'.")
+        cursor.close()
+        invalidate_schema_cache(connection)
+        return True
+    except psycopg2.Error as e:
+        print(f"Error adding key to table: {e}")
+        connection.rollback()
+        return False
+
+def create_secondary_indexes(connection, table_name, indexes):
+    # indexes is a list of column lists, e.g. [['recorded_at'], ['region', 'city']]. Missing
+    # indexes are built with CREATE INDEX CONCURRENTLY so the table stays writable, and an
+    # index left invalid by an earlier failed build is rebuilt.
+    connection.commit()
+    connection.autocommit = True
+    try:
+        cursor = connection.cursor()
+        for index_columns in indexes:
+            index_name = f"{table_name}_{'_'.join(index_columns)}_idx"
+            try:
+                cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index_name,))
+                existing = cursor.fetchone()
+                if existing and existing[0]:
+                    continue
+                if existing:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY {index_name}")
+                column_list = ', '.join([f'"{col}"' for col in index_columns])
+                cursor.execute(f"CREATE INDEX CONCURRENTLY {index_name} ON {table_name} ({column_list})")
+                print(f"Created index '{index_name}'.")
+            except psycopg2.Error as e:
+                print(f"Error creating index '{index_name}': {e}")
+                cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+        cursor.close()
+    finally:
+        connection.autocommit = False
+
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_buffer(rows):
+    # NULL is spelled \N so empty strings survive the round trip
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if cell is None else str(cell).lower() if isinstance(cell, bool) else cell for cell in row])
+    buffer.seek(0)
+    return buffer
+
+def execute_isolating_rejects(cursor, execute_rows, rows, rejects):
+    # Runs execute_rows(rows) under a savepoint. If the database refuses a row (bad value,
+    # key violation) the rows are rolled back and bisected until the offending ones are
+    # found; those are appended to rejects as (row, error) and the rest are written.
+    # Returns the number of rows written.
+    cursor.execute("SAVEPOINT reject_isolation")
+    try:
+        execute_rows(rows)
+        written = len(rows)
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT reject_isolation")
+        if len(rows) == 1:
+            rejects.append((rows[0], str(e).strip()))
+            written = 0
+        else:
+            middle = len(rows) // 2
+            written = (execute_isolating_rejects(cursor, execute_rows, rows[:middle], rejects) +
+                       execute_isolating_rejects(cursor, execute_rows, rows[middle:], rejects))
+    cursor.execute("RELEASE SAVEPOINT reject_isolation")
+    return written
+
+def latest_rows_per_key(rows, key_index):
+    # Later rows win when a key repeats, as in merge_sql; returns the rows left and the
+    # keys that repeated
+    latest = {}
+    repeated_keys = []
+    for row in rows:
+        if row[key_index] in latest:
+            repeated_keys.append(row[key_index])
+        latest[row[key_index]] = row
+    return list(latest.values()), repeated_keys
+
+def insert_data(connection, table_name, columns, data, chunk_size=COPY_CHUNK_SIZE, use_copy=True, before_commit=None, rejects=None,
+                primary_key=None):
+    # data may be any iterable of rows (e.g. a generator over ws.iter_rows); it is
+    # streamed in chunks through COPY ... FROM STDIN, or batched INSERTs if COPY is refused.
+    # before_commit(cursor) runs last inside the transaction, as in the other write paths.
+    # Given a rejects list, refused rows are moved there instead of failing the load.
+    # Given the table's primary_key, a key the sheet repeats keeps its last row, as the
+    # merge path does, instead of failing the load: repeats within a chunk are dropped
+    # before it is sent, and a chunk repeating an earlier chunk's key is upserted.
     try:
         cursor = connection.cursor()
-        placeholders = ', '.join(['%s'] * len(columns))
         insert_columns = ', '.join([f'"{col}"' for col in columns])
-        insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders})'
-       
-        cursor.executemany(insert_sql, data)
+        copy_sql = f"COPY {table_name} ({insert_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES %s'
+        if primary_key:
+            value_columns = [col for col in columns if col != primary_key]
+            update_action = ('DO UPDATE SET ' + ', '.join([f'"{col}" = EXCLUDED."{col}"' for col in value_columns])
+                             if value_columns else 'DO NOTHING')
+            insert_sql += f' ON CONFLICT ("{primary_key}") {update_action}'
+            key_index = columns.index(primary_key)
+
+        insert_rows = lambda rows: extras.execute_values(cursor, insert_sql, rows, page_size=chunk_size)
+
+        def copy_rows(rows):
+            if not primary_key:
+                cursor.copy_expert(copy_sql, csv_buffer(rows))
+                return
+            cursor.execute("SAVEPOINT repeated_key")
+            try:
+                cursor.copy_expert(copy_sql, csv_buffer(rows))
+            except errors.UniqueViolation:
+                cursor.execute("ROLLBACK TO SAVEPOINT repeated_key")
+                insert_rows(rows)
+            cursor.execute("RELEASE SAVEPOINT repeated_key")
+
+        row_count = 0
+        repeated_keys = []
+        first_chunk = True
+        for chunk in chunked(data, chunk_size):
+            if primary_key:
+                chunk, chunk_repeated_keys = latest_rows_per_key(chunk, key_index)
+                repeated_keys.extend(chunk_repeated_keys[:5 - len(repeated_keys)])
+            written = None
+            if use_copy:
+                # Only the first chunk can fall back, nothing has been written yet. The savepoint
+                # keeps any column widening done while that chunk was read.
+                if first_chunk:
+                    cursor.execute("SAVEPOINT bulk_copy")
+                try:
+                    written = copy_rows(chunk) if rejects is None else execute_isolating_rejects(cursor, copy_rows, chunk, rejects)
+                except (errors.InsufficientPrivilege, errors.FeatureNotSupported, psycopg2.NotSupportedError) as e:
+                    if not first_chunk:
+                        raise
+                    print(f"COPY not allowed, falling back to batched INSERT: {e}")
+                    cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy")
+                    use_copy = False
+            if not use_copy:
+                written = insert_rows(chunk) if rejects is None else execute_isolating_rejects(cursor, insert_rows, chunk, rejects)
+            row_count += len(chunk) if rejects is None else written
+            first_chunk = False
+
+        if repeated_keys:
+            print(f"The sheet repeats keys of '{table_name}.{primary_key}', the last row of each was kept: {repeated_keys}")
+        if before_commit is not None:
+            before_commit(cursor)
+        cursor.close()
         connection.commit()
-        print("Data inserted successfully.")
+        print(f"Data inserted successfully ({row_count} rows).")
+        return row_count
     except psycopg2.Error as e:
         print(f"Error inserting data: {e}")
+        connection.rollback()
+        return None
 
-def update_or_insert_data(connection, table_name, columns, data, primary_key):
+def update_or_insert_data(connection, table_name, columns, data, primary_key, before_commit=None, rejects=None):
     try:
         cursor = connection.cursor()
 
@@ -67,101 +608,1109 @@ def update_or_insert_data(connection, table_name, columns, data, primary_key):
         insert_columns = ', '.join([f'"{col}"' for col in columns])
         placeholders = ', '.join(['%s'] * len(columns))
 
-        data = [[str(cell) if isinstance(cell, datetime.datetime) else cell for cell in row] for row in data]
+        # Converted lazily and sent a page at a time, so memory stays flat however long the sheet
+        data = ([str(cell) if isinstance(cell, datetime.datetime) else cell for cell in row] for row in data)
 
         insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders}) ON CONFLICT ({primary_key}) DO UPDATE SET {update_columns}'
 
-        cursor.executemany(insert_sql, data)
+        for chunk in chunked(data, COPY_CHUNK_SIZE):
+            if rejects is None:
+                cursor.executemany(insert_sql, chunk)
+            else:
+                execute_isolating_rejects(cursor, lambda rows: cursor.executemany(insert_sql, rows), chunk, rejects)
+        if before_commit is not None:
+            before_commit(cursor)
         connection.commit()
         print("Data updated & inserted successfully.")
+        return True
     except psycopg2.Error as e:
         print(f"Error updating & inserting data: {e}")
+        connection.rollback()
+        return False
 
-def get_existing_columns(connection, table_name):
+def stage_table_sql(table_name, stage_table):
+    return f"CREATE TEMP TABLE {stage_table} (LIKE {table_name}, merge_row_number BIGSERIAL) ON COMMIT DROP"
+
+def merge_sql(table_name, stage_table, columns, primary_key, row_filter='true'):
+    # Upserts the rows of stage_table (those matching row_filter) that are new or differ
+    # from the table and returns one row with the inserted and updated counts
+    insert_columns = ', '.join([f'"{col}"' for col in columns])
+    value_columns = [col for col in columns if col != primary_key]
+    if value_columns:
+        target_values = ', '.join([f't."{col}"' for col in value_columns])
+        stage_values = ', '.join([f's."{col}"' for col in value_columns])
+        changed_filter = f'OR ({target_values}) IS DISTINCT FROM ({stage_values})'
+        update_action = 'DO UPDATE SET ' + ', '.join([f'"{col}" = EXCLUDED."{col}"' for col in value_columns])
+    else:
+        changed_filter = ''
+        update_action = 'DO NOTHING'
+
+    # Later rows win when a key repeats in the sheet, as with the row-by-row upsert
+    return f"""
+        WITH latest AS (
+            SELECT DISTINCT ON ("{primary_key}") * FROM {stage_table} WHERE {row_filter}
+            ORDER BY "{primary_key}", merge_row_number DESC
+        ), changed AS (
+            SELECT s.* FROM latest s
+            LEFT JOIN {table_name} t ON t."{primary_key}" = s."{primary_key}"
+            WHERE t."{primary_key}" IS NULL {changed_filter}
+        ), upserted AS (
+            INSERT INTO {table_name} ({insert_columns})
+            SELECT {insert_columns} FROM changed
+            ON CONFLICT ("{primary_key}") {update_action}
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+    """
+
+def merge_isolating_rejects(cursor, table_name, stage_table, columns, primary_key, rejects):
+    # The upsert can refuse rows the stage table took, since CHECK and foreign key
+    # constraints are not copied to it. The stage is merged in merge_row_number ranges
+    # bisected by execute_isolating_rejects (all of it at once unless something fails),
+    # and refused rows are appended to rejects with their staged values.
+    # Returns the inserted and updated counts.
+    totals = {'inserted': 0, 'updated': 0}
+    range_merge_sql = merge_sql(table_name, stage_table, columns, primary_key, 'merge_row_number BETWEEN %s AND %s')
+
+    def merge_rows(row_numbers):
+        # row_numbers is a sorted slice, so its range holds no other staged rows
+        cursor.execute(range_merge_sql, (row_numbers[0], row_numbers[-1]))
+        inserted, updated = cursor.fetchone()
+        totals['inserted'] += inserted
+        totals['updated'] += updated
+
+    cursor.execute(f"SELECT merge_row_number FROM {stage_table} ORDER BY 1")
+    row_numbers = [row_number for row_number, in cursor.fetchall()]
+    refused = []
+    if row_numbers:
+        execute_isolating_rejects(cursor, merge_rows, row_numbers, refused)
+    if refused:
+        insert_columns = ', '.join([f'"{col}"' for col in columns])
+        cursor.execute(f"SELECT merge_row_number, {insert_columns} FROM {stage_table} WHERE merge_row_number = ANY(%s)",
+                       ([row_number for row_number, _ in refused],))
+        staged_rows = {row[0]: list(row[1:]) for row in cursor.fetchall()}
+        rejects.extend((staged_rows[row_number], error) for row_number, error in refused)
+    return totals['inserted'], totals['updated'], len(refused)
+
+def merge_data(connection, table_name, columns, data, primary_key, chunk_size=COPY_CHUNK_SIZE, before_commit=None, rejects=None):
+    # COPY the sheet into a temp staging table and apply it with one set-based upsert,
+    # all in a single transaction. Returns inserted/updated/unchanged counts. With a
+    # rejects list, rows the staging table refuses (bad values, NOT NULL) are moved there,
+    # as are rows the upsert itself refuses (CHECK, foreign keys); the staging table only
+    # has the target's column types and NOT NULL constraints.
     try:
         cursor = connection.cursor()
-        cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = '{table_name}'")
-        existing_columns = [row[0] for row in cursor.fetchall()]
+        stage_table = f"{table_name}_stage"
+        insert_columns = ', '.join([f'"{col}"' for col in columns])
+
+        cursor.execute(stage_table_sql(table_name, stage_table))
+        copy_sql = f"COPY {stage_table} ({insert_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        copy_rows = lambda rows: cursor.copy_expert(copy_sql, csv_buffer(rows))
+        staged_rows = 0
+        for chunk in chunked(data, chunk_size):
+            if rejects is None:
+                copy_rows(chunk)
+                staged_rows += len(chunk)
+            else:
+                staged_rows += execute_isolating_rejects(cursor, copy_rows, chunk, rejects)
+
+        if rejects is None:
+            cursor.execute(merge_sql(table_name, stage_table, columns, primary_key))
+            inserted, updated = cursor.fetchone()
+        else:
+            inserted, updated, refused_rows = merge_isolating_rejects(cursor, table_name, stage_table, columns, primary_key, rejects)
+            staged_rows -= refused_rows
+        if before_commit is not None:
+            before_commit(cursor)
         cursor.close()
-        return existing_columns
+        connection.commit()
+
+        counts = {'inserted': inserted, 'updated': updated, 'unchanged': staged_rows - inserted - updated}
+        print(f"Data merged successfully: {counts}")
+        return counts
     except psycopg2.Error as e:
-        print(f"Error retrieving existing columns: {e}")
-        return []
+        print(f"Error merging data: {e}")
+        connection.rollback()
+        return None
 
-def alter_table(connection, table_name, columns):
+def copy_csv_file(connection, table_name, columns, source_path, delimiter=',', primary_key=None, merge=False, before_commit=None):
+    # Zero-parse path for delimited text sources: the file, decompressed on the fly if
+    # gzipped, is handed to COPY as is, header line and all. Without merge it is copied
+    # into the table; with merge into a staging table applied with merge_sql. Empty fields
+    # are NULL, as read_csv_rows reads them. Returns counts like insert_data/merge_data.
     try:
         cursor = connection.cursor()
+        target_table = f"{table_name}_stage" if merge else table_name
+        if merge:
+            cursor.execute(stage_table_sql(table_name, target_table))
+        insert_columns = ', '.join([f'"{col}"' for col in columns])
+        copy_sql = f"COPY {target_table} ({insert_columns}) FROM STDIN WITH (FORMAT csv, HEADER true, DELIMITER '{delimiter}')"
+        with open_source_file(source_path) as f:
+            cursor.copy_expert(copy_sql, f)
+        copied_rows = cursor.rowcount
 
-        existing_columns = get_existing_columns(connection, table_name)
+        if merge:
+            cursor.execute(merge_sql(table_name, target_table, columns, primary_key))
+            inserted, updated = cursor.fetchone()
+            counts = {'inserted': inserted, 'updated': updated, 'unchanged': copied_rows - inserted - updated}
+        else:
+            counts = {'inserted': copied_rows}
+        if before_commit is not None:
+            before_commit(cursor)
+        cursor.close()
+        connection.commit()
+        print(f"File copied straight into {table_name}: {counts}")
+        return counts
+    except psycopg2.Error as e:
+        print(f"Error copying file: {e}")
+        connection.rollback()
+        return None
+
+def get_existing_columns(connection, table_name):
+    table = get_table_schema(connection, table_name)
+    return list(table['columns']) if table else []
+
+def alter_table(connection, table_name, columns, column_types=None):
+    # Returns the columns that were added
+    try:
+        cursor = connection.cursor()
+
+        existing_columns = {col.lower() for col in get_existing_columns(connection, table_name)}
+        column_types = column_types or {}
+        added_columns = []
 
         for column in columns:
             if column.lower() not in existing_columns:
-                alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column} VARCHAR(255)"
+                # IF NOT EXISTS: another process may have added it since the schema cache was loaded
+                alter_sql = f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} {column_types.get(column, 'VARCHAR(255)')}"
                 cursor.execute(alter_sql)
+                existing_columns.add(column.lower())
+                added_columns.append(column)
                 print(f"Altered table '{table_name}' to add column '{column}'.")
 
         connection.commit()
+        if added_columns:
+            invalidate_schema_cache(connection)
+        return added_columns
     except psycopg2.Error as e:
         print(f"Error altering table: {e}")
+        connection.rollback()
+        return []
+
+def typed_row(row):
+    return [cell if cell is None or isinstance(cell, (int, float, bool, datetime.datetime)) else str(cell) for cell in row]
+
+def infer_value_type(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'BOOLEAN'
+    if isinstance(value, int):
+        if -2 ** 31 <= value < 2 ** 31:
+            return 'INTEGER'
+        return 'BIGINT' if -2 ** 63 <= value < 2 ** 63 else 'NUMERIC'
+    if isinstance(value, float):
+        return 'DOUBLE PRECISION'
+    if isinstance(value, datetime.datetime):
+        # Excel stores plain dates as midnight datetimes
+        return 'DATE' if value.time() == datetime.time() and value.tzinfo is None else 'TIMESTAMPTZ'
+    if isinstance(value, datetime.date):
+        return 'DATE'
+    return 'TEXT'
+
+def promote_type(current_type, value_type):
+    # Narrowest type that holds values of both types; None means no value seen yet
+    if current_type is None or current_type == value_type:
+        return value_type or current_type
+    if value_type is None:
+        return current_type
+    pair = {current_type, value_type}
+    if pair <= {'INTEGER', 'BIGINT'}:
+        return 'BIGINT'
+    if pair == {'INTEGER', 'DOUBLE PRECISION'}:
+        return 'DOUBLE PRECISION'
+    if pair <= {'INTEGER', 'BIGINT', 'DOUBLE PRECISION', 'NUMERIC'}:
+        return 'NUMERIC'
+    if pair == {'DATE', 'TIMESTAMPTZ'}:
+        return 'TIMESTAMPTZ'
+    return 'TEXT'
+
+def infer_column_types(columns, rows, sample_size=TYPE_SAMPLE_ROWS, column_type_overrides=None):
+    # Infers a type per column from the first sample_size rows and returns it with the
+    # rows, sample included, still unconsumed. Overrides are used as given.
+    column_type_overrides = column_type_overrides or {}
+    sample = list(islice(rows, sample_size))
+    column_types = {}
+    for i, col in enumerate(columns):
+        if col in column_type_overrides:
+            column_types[col] = column_type_overrides[col]
+            continue
+        column_type = None
+        for row in sample:
+            column_type = promote_type(column_type, infer_value_type(row[i]))
+        column_types[col] = column_type or 'TEXT'
+    return column_types, chain(sample, rows)
 
-def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key):
+def widen_column_types(connection, table_names, columns, column_types, rows):
+    # Passes rows through; when a value does not fit its column's inferred type, the column
+    # is widened on every table in table_names inside the open transaction, before the row
+    # is written. Only columns in column_types are checked.
+    checked_columns = [(i, col) for i, col in enumerate(columns) if col in column_types]
+    for row in rows:
+        for i, col in checked_columns:
+            wider_type = promote_type(column_types[col], infer_value_type(row[i]))
+            if wider_type != column_types[col]:
+                cursor = connection.cursor()
+                for table_name in table_names:
+                    cursor.execute(f'ALTER TABLE {table_name} ALTER COLUMN "{col}" TYPE {wider_type} USING "{col}"::{wider_type}')
+                cursor.close()
+                invalidate_schema_cache(connection)
+                print(f"Widened column '{col}' from {column_types[col]} to {wider_type}.")
+                column_types[col] = wider_type
+        yield row
+
+def parse_text_value(value):
+    # CSV cells arrive as text; give them the Python types openpyxl gives the same cells, so
+    # both sources infer the same column types. Empty cells are NULL, as COPY reads them.
+    if value == '':
+        return None
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    # Leading zeros (codes, zip codes) and digit separators stay text
+    digits = value.lstrip('+-')
+    if digits[:1] in '0123456789.' and '_' not in value and not (len(digits) > 1 and digits[0] == '0' and digits[1].isdigit()):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    if len(value) >= 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+def normalize_header(header):
+    return str(header).lower().replace(' ', '_')
+
+def read_excel_rows(excel_file_path):
+    # Read-only mode parses the sheet lazily; the returned generator yields one typed
+    # row at a time and closes the workbook once it is exhausted
+    wb = load_workbook(excel_file_path, read_only=True)
+    ws = wb.active
+    columns = [normalize_header(cell.value) for cell in ws[1]]
+
+    def typed_rows():
+        try:
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                yield typed_row(row)
+        finally:
+            wb.close()
+
+    return columns, typed_rows()
+
+def open_source_file(source_path, mode='rb'):
+    # .gz sources are decompressed on the fly; text mode drops a leading UTF-8 BOM
+    text_options = {'encoding': 'utf-8-sig', 'newline': ''} if 't' in mode else {}
+    if source_path.lower().endswith('.gz'):
+        return gzip.open(source_path, mode, **text_options)
+    return open(source_path, mode.replace('t', ''), **text_options)
+
+def read_csv_rows(source_path, delimiter=','):
+    # Same contract as read_excel_rows: normalized headers and a lazy generator of typed
+    # rows that closes the file once it is exhausted
+    f = open_source_file(source_path, 'rt')
+    reader = csv.reader(f, delimiter=delimiter)
+    columns = [normalize_header(header) for header in next(reader, [])]
+
+    def typed_rows():
+        try:
+            for row in reader:
+                yield typed_row([parse_text_value(cell) for cell in row])
+        finally:
+            f.close()
+
+    return columns, typed_rows()
+
+def read_tsv_rows(source_path):
+    return read_csv_rows(source_path, '\t')
+
+# Readers by source format, each taking a path and returning (columns, rows) like
+# read_excel_rows; add an entry (and a suffix below) to load another format
+SOURCE_READERS = {'xlsx': read_excel_rows, 'csv': read_csv_rows, 'tsv': read_tsv_rows}
+
+# Source format by file suffix; a further .gz suffix is allowed on csv and tsv
+SOURCE_SUFFIXES = {'.xlsx': 'xlsx', '.xlsm': 'xlsx', '.csv': 'csv', '.tsv': 'tsv'}
+
+# Formats that are delimited text as COPY reads it, with their delimiter
+CSV_DELIMITERS = {'csv': ',', 'tsv': '\t'}
+
+def detect_source_format(source_path):
+    name = source_path.lower()
+    compressed = name.endswith('.gz')
+    source_format = SOURCE_SUFFIXES.get(os.path.splitext(name[:-3] if compressed else name)[1])
+    if source_format is None or (compressed and source_format not in CSV_DELIMITERS):
+        raise ValueError(f"Unsupported source file '{source_path}'; expected one of {sorted(SOURCE_SUFFIXES)} (csv and tsv may be gzipped).")
+    return source_format
+
+def read_source_rows(source_path, source_format=None):
+    return SOURCE_READERS[source_format or detect_source_format(source_path)](source_path)
+
+def pipelined_rows(rows, chunk_size=COPY_CHUNK_SIZE, queue_depth=PIPELINE_QUEUE_DEPTH):
+    # Iterates rows in a reader thread that keeps up to queue_depth chunks parsed ahead, so
+    # parsing overlaps with the database writing earlier chunks. Errors in the reader are
+    # raised here; closing the generator stops the reader and closes rows.
+    parsed_chunks = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    end_of_rows = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                parsed_chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for chunk in chunked(rows, chunk_size):
+                if not put(chunk):
+                    return
+            put(end_of_rows)
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+
+    reader = threading.Thread(target=read, name='excel-reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = parsed_chunks.get()
+            if chunk is end_of_rows:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        stop.set()
+        reader.join()
+
+def ensure_checkpoint_table(connection):
+    if table_exists(connection, CHECKPOINT_TABLE):
+        return
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            source TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            rows_committed BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    cursor.close()
+    connection.commit()
+    invalidate_schema_cache(connection)
+
+def load_checkpoint(connection, source, content_hash):
+    # Rows of this exact file already committed by an interrupted load; a checkpoint
+    # left by a different version of the file is discarded
+    ensure_checkpoint_table(connection)
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT content_hash, rows_committed FROM {CHECKPOINT_TABLE} WHERE source = %s", (source,))
+    checkpoint = cursor.fetchone()
+    cursor.close()
+    if checkpoint is None:
+        return 0
+    if checkpoint[0] != content_hash:
+        clear_checkpoint(connection, source)
+        return 0
+    return checkpoint[1]
+
+def save_checkpoint(cursor, source, content_hash, rows_committed):
+    # Runs inside the transaction of the batch it records; does not commit
+    cursor.execute(f"""
+        INSERT INTO {CHECKPOINT_TABLE} (source, content_hash, rows_committed) VALUES (%s, %s, %s)
+        ON CONFLICT (source) DO UPDATE SET content_hash = EXCLUDED.content_hash,
+            rows_committed = EXCLUDED.rows_committed, updated_at = now()
+    """, (source, content_hash, rows_committed))
+
+def clear_checkpoint(connection, source, commit=True):
+    cursor = connection.cursor()
+    cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE source = %s", (source,))
+    cursor.close()
+    if commit:
+        connection.commit()
+
+def rejects_table_handler(connection, source, table_name, columns):
+    # Returns a reject handler that inserts rejected rows into REJECTS_TABLE inside the
+    # transaction of the batch they were rejected from
+    if not table_exists(connection, REJECTS_TABLE):
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {REJECTS_TABLE} (
+                rejected_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                source TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                row_data JSONB NOT NULL,
+                error TEXT NOT NULL
+            )
+        """)
+        cursor.close()
+        connection.commit()
+        invalidate_schema_cache(connection)
+
+    def handle_rejects(cursor, rejected):
+        extras.execute_values(
+            cursor,
+            f"INSERT INTO {REJECTS_TABLE} (source, table_name, row_data, error) VALUES %s",
+            [(source, table_name, extras.Json(dict(zip(columns, row)), dumps=lambda data: json.dumps(data, default=str)), error)
+             for row, error in rejected]
+        )
+
+    return handle_rejects
+
+def rejects_file_handler(rejects_file, source, table_name, columns):
+    # Returns a reject handler that appends rejected rows to rejects_file as JSON lines.
+    # The file is written before the batch commits, so a batch that then fails to commit
+    # leaves its rejects behind.
+    def handle_rejects(cursor, rejected):
+        with open(rejects_file, 'a', encoding='utf-8') as f:
+            for row, error in rejected:
+                record = {'rejected_at': datetime.datetime.now().isoformat(), 'source': source, 'table_name': table_name,
+                          'row_data': dict(zip(columns, row)), 'error': error}
+                f.write(json.dumps(record, default=str) + '\n')
+
+    return handle_rejects
+
+def prepare_swap_table(connection, table_name, swap_table, resuming=False):
+    # The load writes into swap_table, which starts as a copy of table_name (or does not
+    # exist yet for a new table). Changes made to table_name after the copy are lost at
+    # the swap, and views or foreign keys referencing table_name are not carried over.
     try:
-        wb = load_workbook(excel_file_path)
-        ws = wb.active
-        print("Excel file read successfully.")
+        if resuming and table_exists(connection, swap_table):
+            print(f"Resuming into swap table '{swap_table}'.")
+            return True
+        cursor = connection.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS {swap_table}")
+        if table_exists(connection, table_name):
+            cursor.execute(f"CREATE TABLE {swap_table} (LIKE {table_name} INCLUDING ALL)")
+            cursor.execute(f"INSERT INTO {swap_table} SELECT * FROM {table_name}")
+        cursor.close()
+        connection.commit()
+        invalidate_schema_cache(connection)
+        return True
+    except psycopg2.Error as e:
+        print(f"Error preparing swap table: {e}")
+        connection.rollback()
+        return False
 
-        # Extract column names
-        columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
+def swap_tables(connection, table_name, swap_table, checkpoint_source=None):
+    # Replaces table_name with the fully loaded swap_table in one transaction
+    try:
+        cursor = connection.cursor()
+        old_table = f"{table_name}_old"
+        if table_exists(connection, table_name):
+            cursor.execute(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE")
+            cursor.execute(f"ALTER TABLE {table_name} RENAME TO {old_table}")
+            cursor.execute(f"ALTER TABLE {swap_table} RENAME TO {table_name}")
+            cursor.execute(f"DROP TABLE {old_table}")
+        else:
+            cursor.execute(f"ALTER TABLE {swap_table} RENAME TO {table_name}")
+        cursor.close()
+        if checkpoint_source is not None:
+            clear_checkpoint(connection, checkpoint_source, commit=False)
+        connection.commit()
+        invalidate_schema_cache(connection)
+        print(f"Swapped '{swap_table}' in as '{table_name}'.")
+        return True
+    except psycopg2.Error as e:
+        print(f"Error swapping in '{swap_table}': {e}")
+        connection.rollback()
+        return False
 
-        # Extract data rows
-        data = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            data.append([cell if isinstance(cell, (int, float, bool, datetime.datetime)) else str(cell) for cell in row])
+def arrow_type(type_code):
+    # Arrow type for a column from its PostgreSQL type OID; anything else, NUMERIC
+    # included, is exported as its text form so no precision is lost
+    return {
+        16: pa.bool_(),
+        20: pa.int64(),
+        21: pa.int16(),
+        23: pa.int32(),
+        700: pa.float32(),
+        701: pa.float64(),
+        1082: pa.date32(),
+        1114: pa.timestamp('us'),
+        1184: pa.timestamp('us', tz='UTC'),
+    }.get(type_code, pa.string())
 
-        print("Columns in the Excel file:", columns)
-        print("First few rows of data:", data[:5])
+def export_table_to_parquet(connection, table_name, export_dir, run_id, partition_by=None, written_xids=None,
+                            batch_rows=EXPORT_BATCH_ROWS):
+    # Streams table_name through a server-side cursor into a Parquet dataset at
+    # export_dir/table_name (hive-partitioned by partition_by), batch_rows per file, so
+    # memory stays bounded whatever the table size. Every row carries the run_id in
+    # _sync_run. Without written_xids the dataset is rebuilt beside the old one and then
+    # swapped in; with it, only rows last written by those transactions are appended, and
+    # readers keep the latest _sync_run per key. xmin has no index, so the incremental
+    # export still reads the whole table once (a sequential scan), though it only writes
+    # the rows that changed. Returns the number of rows exported, or None on failure, in
+    # which case the files this run had written are removed.
+    if pq is None:
+        print("pyarrow is not installed, skipping the Parquet export.")
+        return None
 
-        connection = create_postgres_connection(db_params)
-        
-        if connection:
-            if table_exists(connection, table_name):
-                print(f"Table '{table_name}' already exists. Checking and updating schema if needed...")
-                alter_table(connection, table_name, columns)
-                update_or_insert_data(connection, table_name, columns, data, primary_key)
+    dataset_dir = os.path.join(export_dir, table_name)
+    incremental = written_xids is not None
+    target_dir = dataset_dir if incremental else f"{dataset_dir}.tmp-{run_id}"
+    try:
+        with connection.cursor(name=f"{table_name}_export") as cursor:
+            cursor.itersize = batch_rows
+            if incremental:
+                # xmin holds the 32-bit id of the transaction that last wrote the row
+                cursor.execute(f"SELECT * FROM {table_name} WHERE xmin::text::bigint = ANY(%s)",
+                               ([xid % 2 ** 32 for xid in written_xids],))
             else:
-                print(f"Table '{table_name}' does not exist. Creating and inserting data.")
-                create_table(connection, table_name, columns)
-                insert_data(connection, table_name, columns, data)
-        
-            connection.close()
-            print("PostgreSQL Database connection closed.")
+                cursor.execute(f"SELECT * FROM {table_name}")
+
+            exported_rows = 0
+            schema = None
+            for batch_number in count():
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                if schema is None:
+                    schema = pa.schema([(col.name, arrow_type(col.type_code)) for col in cursor.description] + [('_sync_run', pa.string())])
+                columns = {}
+                for i, field in enumerate(schema.names[:-1]):
+                    values = [row[i] for row in rows]
+                    if schema.field(field).type == pa.string():
+                        values = [None if value is None else str(value) for value in values]
+                    columns[field] = values
+                columns['_sync_run'] = [run_id] * len(rows)
+                pq.write_to_dataset(pa.Table.from_pydict(columns, schema=schema), target_dir, partition_cols=partition_by or None,
+                                    basename_template=f"{run_id}-{batch_number}-{{i}}.parquet",
+                                    existing_data_behavior='overwrite_or_ignore')
+                exported_rows += len(rows)
+        connection.commit()
+    except (psycopg2.Error, pa.ArrowException, OSError) as e:
+        print(f"Error exporting '{table_name}' to Parquet: {e}")
+        connection.rollback()
+        if incremental:
+            for partial_file in glob.glob(os.path.join(target_dir, '**', f"{run_id}-*.parquet"), recursive=True):
+                os.remove(partial_file)
+        else:
+            shutil.rmtree(target_dir, ignore_errors=True)
+        return None
+
+    if not incremental:
+        os.makedirs(target_dir, exist_ok=True)
+        old_dir = f"{dataset_dir}.old-{run_id}"
+        if os.path.exists(dataset_dir):
+            os.replace(dataset_dir, old_dir)
+        os.replace(target_dir, dataset_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Exported {exported_rows} rows of '{table_name}' to {dataset_dir}.")
+    return exported_rows
+
+def write_rows_to_postgres(connection, table_name, columns, rows, primary_key, chunk_size=COPY_CHUNK_SIZE, use_copy=True, merge=True,
+                           infer_types=True, column_type_overrides=None, metrics=None, commit_every=None, checkpoint=None,
+                           reject_handler=None, written_xids=None, csv_source=None, added_columns=None):
+    # Returns the row counts written, or None if the write failed. With infer_types, new
+    # tables and columns get types inferred from a sample of rows instead of VARCHAR(255),
+    # widened later in the same transaction if a row does not fit. With commit_every, rows
+    # are written and committed in batches of that many (held in memory), and checkpoint,
+    # a (source, content_hash, rows_already_committed) tuple, is advanced with each batch.
+    # With reject_handler, rows the database refuses are isolated and passed to
+    # reject_handler(cursor, [(row, error), ...]) before their batch commits. Given a
+    # written_xids list, the id of every transaction that wrote rows is appended to it.
+    # csv_source, a (path, delimiter) pair for the delimited file rows were read from, lets
+    # new tables and merges COPY that file as is; rows are then only read for the type sample.
+    # Given an added_columns list, the columns this call adds to an existing table are
+    # appended to it, and every column in it is widened as a new one would be; a retry
+    # passes the same list so columns added by the failed attempt can still widen.
+    with timed_phase(metrics, 'schema'):
+        column_types = None
+        if infer_types:
+            column_types, rows = infer_column_types(columns, rows, TYPE_SAMPLE_ROWS, column_type_overrides)
+            inferred_types = {col: col_type for col, col_type in column_types.items() if col not in (column_type_overrides or {})}
+
+        exists = table_exists(connection, table_name)
+        if exists:
+            print(f"Table '{table_name}' already exists. Checking and updating schema if needed...")
+            new_columns = alter_table(connection, table_name, columns, column_types)
+            if added_columns is None:
+                added_columns = new_columns
+            else:
+                added_columns.extend(col for col in new_columns if col not in added_columns)
+            ensure_key_constraint(connection, table_name, primary_key)
+        else:
+            print(f"Table '{table_name}' does not exist. Creating and inserting data.")
+            create_table(connection, table_name, columns, column_types, primary_key)
+
+    rows = metered_rows(metrics, rows, counter='rows_written')
+    rejects = [] if reject_handler is not None else None
+    rejected_rows = 0
+    with timed_phase(metrics, 'write'):
+        if exists and merge:
+            if column_types:
+                # merge_data stages rows in a copy of the table, which has to widen with it. With
+                # commit_every a batch is read (and widened) before its stage table exists, but
+                # the stage is then created LIKE the already widened table.
+                new_column_types = {col: inferred_types[col] for col in added_columns if col in inferred_types}
+                widened_tables = [table_name] if commit_every else [table_name, f"{table_name}_stage"]
+                rows = widen_column_types(connection, widened_tables, columns, new_column_types, rows)
+            write_batch = lambda batch, before_commit: merge_data(connection, table_name, columns, batch, primary_key, chunk_size,
+                                                                  before_commit, rejects)
+        elif exists:
+            write_batch = lambda batch, before_commit: (
+                {} if update_or_insert_data(connection, table_name, columns, batch, primary_key, before_commit, rejects) else None)
+        else:
+            if column_types:
+                rows = widen_column_types(connection, [table_name], columns, inferred_types, rows)
+
+            def write_batch(batch, before_commit):
+                inserted = insert_data(connection, table_name, columns, batch, chunk_size, use_copy, before_commit, rejects, primary_key)
+                return None if inserted is None else {'inserted': inserted}
+
+        def finish_batch(cursor, rows_committed):
+            nonlocal rejected_rows
+            if written_xids is not None:
+                cursor.execute("SELECT txid_current()")
+                written_xids.append(cursor.fetchone()[0])
+            if checkpoint:
+                save_checkpoint(cursor, checkpoint[0], checkpoint[1], rows_committed)
+            if rejects:
+                reject_handler(cursor, rejects)
+                print(f"Rejected {len(rejects)} rows, first error: {rejects[0][1]}")
+                rejected_rows += len(rejects)
+                rejects.clear()
+
+        passthrough = (csv_source is not None and (merge if exists else use_copy) and not commit_every
+                       and reject_handler is None)
+        if passthrough:
+            counts = copy_csv_file(connection, table_name, columns, csv_source[0], csv_source[1], primary_key, exists,
+                                   (lambda cursor: finish_batch(cursor, None)) if written_xids is not None else None)
+            if counts is None and not exists:
+                # Drop the table made for the file, so a retry with parsed rows starts over
+                # and can widen columns whose sampled type turned out too narrow
+                cursor = connection.cursor()
+                cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+                cursor.close()
+                connection.commit()
+                invalidate_schema_cache(connection)
+            elif counts is not None and metrics is not None:
+                # The server read the file, only the type sample was parsed here
+                metrics['counters']['rows_read'] = sum(counts.values())
+                metrics['counters']['rows_written'] += sum(counts.values())
+        elif commit_every:
+            counts = {}
+            rows_committed = checkpoint[2] if checkpoint else 0
+            for batch in chunked(rows, commit_every):
+                rows_committed += len(batch)
+                batch_counts = write_batch(batch, lambda cursor, done=rows_committed: finish_batch(cursor, done))
+                if batch_counts is None:
+                    print(f"Stopped after {rows_committed - len(batch)} committed rows; a rerun resumes from there.")
+                    counts = None
+                    break
+                for key, value in batch_counts.items():
+                    counts[key] = counts.get(key, 0) + value
+        else:
+            needs_hook = rejects is not None or written_xids is not None
+            counts = write_batch(rows, (lambda cursor: finish_batch(cursor, None)) if needs_hook else None)
+
+    if counts is not None and rejected_rows:
+        counts['rejected'] = rejected_rows
+        if metrics is not None:
+            metrics['counters']['rows_rejected'] += rejected_rows
+
+    if metrics is not None and counts is not None:
+        # The row-by-row upsert cannot tell unchanged rows apart, so all of them count
+        if 'inserted' in counts or 'updated' in counts:
+            metrics['counters']['rows_changed'] += counts.get('inserted', 0) + counts.get('updated', 0)
+        else:
+            metrics['counters']['rows_changed'] += metrics['counters']['rows_written'] - rejected_rows
+    return counts
+
+def open_sync_state(sync_state_path=SYNC_STATE_PATH):
+    sync_state = sqlite3.connect(sync_state_path)
+    sync_state.execute("CREATE TABLE IF NOT EXISTS synced_files (source TEXT PRIMARY KEY, mtime REAL, size INTEGER, content_hash TEXT)")
+    sync_state.execute("CREATE TABLE IF NOT EXISTS synced_rows (source TEXT, row_key TEXT, row_hash TEXT, PRIMARY KEY (source, row_key))")
+    return sync_state
+
+def sync_source(excel_file_path, table_name, db_params=None):
+    # The same workbook may feed several tables, or databases (staging and prod), so the
+    # local sync state is kept per file, table and, given db_params, target database.
+    # Checkpoints live in the target database itself and leave db_params out.
+    source = f"{os.path.abspath(excel_file_path)}::{table_name}"
+    if db_params is not None:
+        source = f"{db_params['host']}:{db_params['port']}/{db_params['database']}::{source}"
+    return source
+
+def file_content_hash(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+def file_unchanged_since_sync(sync_state, source, excel_file_path):
+    synced = sync_state.execute("SELECT mtime, size, content_hash FROM synced_files WHERE source = ?", (source,)).fetchone()
+    if synced is None:
+        return False
+    stat = os.stat(excel_file_path)
+    if (stat.st_mtime, stat.st_size) == (synced[0], synced[1]):
+        return True
+    if stat.st_size == synced[1] and file_content_hash(excel_file_path) == synced[2]:
+        # Touched but not modified; remember the new mtime so the next check stays cheap
+        sync_state.execute("UPDATE synced_files SET mtime = ? WHERE source = ?", (stat.st_mtime, source))
+        sync_state.commit()
+        return True
+    return False
+
+def forget_synced_source(sync_state, source):
+    sync_state.execute("DELETE FROM synced_files WHERE source = ?", (source,))
+    sync_state.execute("DELETE FROM synced_rows WHERE source = ?", (source,))
+    sync_state.commit()
+
+def skip_synced_rows(sync_state, source, columns, rows, primary_key):
+    # Yields only the rows that are new or changed since the last sync, collecting their
+    # hashes in the returned dict so they can be saved once the write has succeeded
+    synced_hashes = dict(sync_state.execute("SELECT row_key, row_hash FROM synced_rows WHERE source = ?", (source,)))
+    changed_hashes = {}
+    key_index = columns.index(primary_key)
+
+    def changed_rows():
+        for row in rows:
+            key = str(row[key_index])
+            row_hash = hashlib.md5('\x1f'.join([str(cell) for cell in row]).encode('utf-8')).hexdigest()
+            if synced_hashes.get(key) != row_hash:
+                changed_hashes[key] = row_hash
+                yield row
+
+    return changed_rows(), changed_hashes
+
+def file_state(file_path):
+    # Taken before the file is read, so a file changed mid-load is not recorded as synced
+    stat = os.stat(file_path)
+    return stat.st_mtime, stat.st_size, file_content_hash(file_path)
+
+def unsynced_rejects_handler(reject_handler, changed_hashes, key_index):
+    # Wraps a reject handler so rejected rows are left out of the sync state; they are
+    # then sent again on the next sync instead of counting as synced
+    def handle_rejects(cursor, rejected):
+        for row, _ in rejected:
+            changed_hashes.pop(str(row[key_index]), None)
+        reject_handler(cursor, rejected)
+
+    return handle_rejects
+
+def save_sync_state(sync_state, source, synced_file_state, changed_hashes):
+    # synced_file_state is the file_state() of the file as it was when the load read it
+    sync_state.execute("INSERT OR REPLACE INTO synced_files (source, mtime, size, content_hash) VALUES (?, ?, ?, ?)",
+                       (source,) + tuple(synced_file_state))
+    sync_state.executemany("INSERT OR REPLACE INTO synced_rows (source, row_key, row_hash) VALUES (?, ?, ?)",
+                           [(source, key, row_hash) for key, row_hash in changed_hashes.items()])
+    sync_state.commit()
+
+def load_source_into_postgres(db_params, table_name, source_path, primary_key, chunk_size=COPY_CHUNK_SIZE, use_copy=True, merge=True,
+                                  statement_timeout=None, sync_state_path=None, infer_types=True, column_type_overrides=None,
+                                  metrics_sinks=None, pipeline=False, pipeline_queue_depth=PIPELINE_QUEUE_DEPTH, commit_every=None,
+                                  atomic_swap=False, reject_rows=False, rejects_file=None, secondary_indexes=None, export_dir=None,
+                                  export_mode='incremental', export_partition_by=None, source_format=None, csv_passthrough=True):
+    # source_path is an Excel workbook or a csv/tsv file, gzipped or not; source_format
+    # ('xlsx', 'csv', 'tsv' or another key of SOURCE_READERS) defaults to the file suffix.
+    # With csv_passthrough, delimited files go to COPY unparsed where the write allows it
+    # (new tables and merges), falling back to parsed rows if COPY refuses the file.
+    # With sync_state_path, files unchanged since their last sync are skipped without being
+    # parsed and only new or changed rows are sent; the state is reset if the table is gone.
+    # With pipeline, the sheet is parsed in a reader thread up to pipeline_queue_depth
+    # chunks ahead of the write, and parse time only counts while the write waits on it.
+    # With commit_every, rows are committed in batches and a rerun after a failure skips
+    # the rows already committed. With atomic_swap, the load goes into a copy of the table
+    # that replaces it only once every row is in, so readers never see a partial load.
+    # With reject_rows, rows the database refuses are written to REJECTS_TABLE (or appended
+    # to rejects_file as JSON lines) with their error, and the remaining rows are loaded.
+    # secondary_indexes (default SECONDARY_INDEXES[table_name]) are built once the load succeeds.
+    # With export_dir, the table is then exported to Parquet: only the rows this load
+    # wrote with export_mode='incremental', the whole table with 'snapshot'.
+    # Returns the run's metrics, which are also passed to each of metrics_sinks.
+    metrics = new_sync_metrics(source_path, table_name)
+    start = time.perf_counter()
+    sync_state = open_sync_state(sync_state_path) if sync_state_path else None
+    parsed_rows = None
+    try:
+        with postgres_session(db_params, statement_timeout, metrics) as connection:
+            if sync_state is not None:
+                source = sync_source(source_path, table_name, db_params)
+                with timed_phase(metrics, 'diff'):
+                    if not table_exists(connection, table_name):
+                        forget_synced_source(sync_state, source)
+                    elif file_unchanged_since_sync(sync_state, source, source_path):
+                        print(f"Source file '{source_path}' is unchanged since the last sync, skipping.")
+                        return metrics
+                    synced_file_state = file_state(source_path)
+
+            source_format = source_format or detect_source_format(source_path)
+
+            def open_rows():
+                nonlocal parsed_rows
+                with timed_phase(metrics, 'open'):
+                    columns, rows = read_source_rows(source_path, source_format)
+                if pipeline:
+                    rows = parsed_rows = pipelined_rows(rows, chunk_size, pipeline_queue_depth)
+                return columns, metered_rows(metrics, rows, 'parse', 'rows_read')
+
+            columns, rows = open_rows()
+            print(f"Source file opened for streaming ({source_format}).")
+
+            # Peek at the first rows without materializing the rest of the sheet
+            first_rows = list(islice(rows, 5))
+            rows = chain(first_rows, rows)
+
+            print("Columns in the source file:", columns)
+            print("First few rows of data:", first_rows)
+
+            if sync_state is not None:
+                with timed_phase(metrics, 'fetch_existing'):
+                    rows, changed_hashes = skip_synced_rows(sync_state, source, columns, rows, primary_key)
+                rows = metered_rows(metrics, rows, 'diff')
+
+            target_table = f"{table_name}_swap" if atomic_swap else table_name
+            checkpoint = None
+            if commit_every:
+                checkpoint_source = sync_source(source_path, target_table)
+                content_hash = file_content_hash(source_path)
+                rows_committed = load_checkpoint(connection, checkpoint_source, content_hash)
+                if rows_committed and atomic_swap and not table_exists(connection, target_table):
+                    # The partly loaded swap table is gone, so start over
+                    clear_checkpoint(connection, checkpoint_source)
+                    rows_committed = 0
+                if rows_committed:
+                    print(f"Resuming after {rows_committed} rows committed by an earlier run.")
+                    rows = islice(rows, rows_committed, None)
+                checkpoint = (checkpoint_source, content_hash, rows_committed)
+
+            reject_handler = None
+            if reject_rows:
+                if rejects_file:
+                    reject_handler = rejects_file_handler(rejects_file, source_path, table_name, columns)
+                else:
+                    reject_handler = rejects_table_handler(connection, source_path, table_name, columns)
+                if sync_state is not None:
+                    reject_handler = unsynced_rejects_handler(reject_handler, changed_hashes, columns.index(primary_key))
+
+            # Rows skipped by the sync state are not in the file's own rows, so it can't be copied whole
+            csv_source = None
+            if csv_passthrough and source_format in CSV_DELIMITERS and sync_state is None:
+                csv_source = (source_path, CSV_DELIMITERS[source_format])
+
+            if atomic_swap and not prepare_swap_table(connection, table_name, target_table, bool(checkpoint and checkpoint[2])):
+                counts = None
+            else:
+                written_xids = [] if export_dir and export_mode == 'incremental' else None
+                added_columns = []
+                counts = write_rows_to_postgres(connection, target_table, columns, rows, primary_key, chunk_size, use_copy, merge,
+                                                infer_types, column_type_overrides, metrics, commit_every, checkpoint, reject_handler,
+                                                written_xids, csv_source, added_columns)
+                if counts is None and csv_source is not None:
+                    print("Falling back to loading parsed rows.")
+                    if parsed_rows is not None:
+                        parsed_rows.close()
+                    metrics['counters']['rows_read'] = 0
+                    columns, rows = open_rows()
+                    counts = write_rows_to_postgres(connection, target_table, columns, rows, primary_key, chunk_size, use_copy, merge,
+                                                    infer_types, column_type_overrides, metrics, commit_every, checkpoint, reject_handler,
+                                                    written_xids, None, added_columns)
+            if counts is not None and atomic_swap:
+                if not swap_tables(connection, table_name, target_table, checkpoint and checkpoint[0]):
+                    counts = None
+            elif counts is not None and checkpoint:
+                clear_checkpoint(connection, checkpoint[0])
+
+            if secondary_indexes is None:
+                secondary_indexes = SECONDARY_INDEXES.get(table_name)
+            if counts is not None and secondary_indexes:
+                with timed_phase(metrics, 'schema'):
+                    create_secondary_indexes(connection, table_name, secondary_indexes)
+
+            if counts is not None and export_dir:
+                run_id = datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+                with timed_phase(metrics, 'export'):
+                    exported_rows = export_table_to_parquet(connection, table_name, export_dir, run_id, export_partition_by,
+                                                            written_xids)
+                if exported_rows is None:
+                    # The table itself was written, so the run still succeeds; only the export is flagged
+                    metrics['export_error'] = "export failed, see log"
+
+            if counts is None:
+                # The cached schema may be what sent the write down the wrong path
+                invalidate_schema_cache(connection)
+                metrics['error'] = "write failed, see log"
+            elif sync_state is not None:
+                with timed_phase(metrics, 'commit'):
+                    save_sync_state(sync_state, source, synced_file_state, changed_hashes)
+                print(f"Sync state saved, {len(changed_hashes)} new or changed rows.")
+
+        print("PostgreSQL Database connection returned to the pool.")
 
     except FileNotFoundError as e:
         print(f"Error: {e}")
+        metrics['error'] = str(e)
     except KeyError as e:
         print(f"KeyError: {e}")
+        metrics['error'] = f"KeyError: {e}"
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
+        metrics['error'] = str(e)
+    finally:
+        if parsed_rows is not None:
+            parsed_rows.close()
+        if sync_state is not None:
+            sync_state.close()
+        metrics['seconds'] = time.perf_counter() - start
+        emit_sync_metrics(metrics, metrics_sinks)
+    return metrics
+
+# The loader predates the csv/tsv readers; existing callers keep using this name
+load_excel_data_into_postgres = load_source_into_postgres
+
+def parse_excel_workbook(excel_file_path, sheet_names):
+    # Runs in a worker process: parses every listed sheet that the workbook has
+    wb = load_workbook(excel_file_path, read_only=True)
+    try:
+        sheets = []
+        for sheet_name in wb.sheetnames:
+            if sheet_name in sheet_names:
+                ws = wb[sheet_name]
+                columns = [normalize_header(cell.value) for cell in ws[1]]
+                rows = [typed_row(row) for row in ws.iter_rows(min_row=2, values_only=True)]
+                sheets.append((sheet_name, columns, rows))
+        return sheets
+    finally:
+        wb.close()
+
+def write_excel_sheet(db_params, excel_file_path, sheet_name, table_name, columns, rows, primary_key, table_lock,
+                      chunk_size=COPY_CHUNK_SIZE, use_copy=True, merge=True, statement_timeout=None, infer_types=True,
+                      column_type_overrides=None, metrics_sinks=None):
+    # The sheet was parsed in a worker process, so its metrics start at 'connect'
+    result = {'file': excel_file_path, 'sheet': sheet_name, 'table': table_name, 'rows': len(rows), 'error': None}
+    metrics = new_sync_metrics(f"{excel_file_path}[{sheet_name}]", table_name)
+    metrics['counters']['rows_read'] = len(rows)
+    start = time.perf_counter()
+    try:
+        # Sheets feeding the same table are written one at a time so CREATE/ALTER don't race
+        with table_lock, postgres_session(db_params, statement_timeout, metrics) as connection:
+            counts = write_rows_to_postgres(connection, table_name, columns, rows, primary_key, chunk_size, use_copy, merge,
+                                            infer_types, column_type_overrides, metrics)
+        if counts is None:
+            result['error'] = "write failed, see log"
+        else:
+            result.update(counts)
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    metrics['seconds'] = time.perf_counter() - start
+    metrics['error'] = result['error']
+    emit_sync_metrics(metrics, metrics_sinks)
+    result['metrics'] = metrics
+    return result
+
+def load_excel_files_into_postgres(db_params, excel_source, sheet_tables, primary_key, parse_workers=None,
+                                   write_concurrency=POOL_MAX_CONNECTIONS, chunk_size=COPY_CHUNK_SIZE, use_copy=True,
+                                   merge=True, statement_timeout=None, infer_types=True, column_type_overrides=None,
+                                   metrics_sinks=None):
+    # excel_source is a directory (every .xlsx in it) or a glob pattern, and sheet_tables maps
+    # sheet names to target tables; unmapped sheets are skipped. Workbooks are parsed in a
+    # process pool and each parsed sheet is written by one of write_concurrency threads
+    # sharing the connection pool. Returns one result dict per sheet.
+    if os.path.isdir(excel_source):
+        excel_files = sorted(glob.glob(os.path.join(excel_source, '*.xlsx')))
+    else:
+        excel_files = sorted(glob.glob(excel_source))
+    print(f"Found {len(excel_files)} Excel files to load.")
+
+    results = []
+    write_futures = []
+    table_locks = defaultdict(threading.Lock)
+    # Parsed sheets wait in this process until they are written, so only write_concurrency
+    # workbooks are parsed or being written at a time and memory doesn't grow with the folder
+    max_in_flight = max(write_concurrency, 1)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    with ProcessPoolExecutor(max_workers=parse_workers) as parsers, ThreadPoolExecutor(max_workers=write_concurrency) as writers:
+        def workbook_parsed(future, excel_file_path):
+            # Runs as the parse future's callback; the workbook's slot is freed once its last sheet is written
+            try:
+                sheets = future.result()
+            except Exception as e:
+                print(f"Error reading Excel file '{excel_file_path}': {e}")
+                results.append({'file': excel_file_path, 'sheet': None, 'table': None, 'rows': 0, 'error': str(e)})
+                sheets = []
+            if not sheets:
+                in_flight.release()
+                return
+
+            unwritten = [len(sheets)]
+            unwritten_lock = threading.Lock()
+
+            def sheet_written(_):
+                with unwritten_lock:
+                    unwritten[0] -= 1
+                    last = unwritten[0] == 0
+                if last:
+                    in_flight.release()
+
+            for sheet_name, columns, rows in sheets:
+                table_name = sheet_tables[sheet_name]
+                write_future = writers.submit(write_excel_sheet, db_params, excel_file_path, sheet_name, table_name, columns, rows,
+                                              primary_key, table_locks[table_name], chunk_size, use_copy, merge, statement_timeout,
+                                              infer_types, column_type_overrides, metrics_sinks)
+                write_futures.append(write_future)
+                write_future.add_done_callback(sheet_written)
+
+        for excel_file_path in excel_files:
+            in_flight.acquire()
+            parse_future = parsers.submit(parse_excel_workbook, excel_file_path, list(sheet_tables))
+            parse_future.add_done_callback(lambda future, path=excel_file_path: workbook_parsed(future, path))
+
+        # Every slot is free again once the last workbook is written
+        for _ in range(max_in_flight):
+            in_flight.acquire()
+        results.extend(future.result() for future in write_futures)
+
+    for result in results:
+        status = f"failed: {result['error']}" if result['error'] else f"{result['rows']} rows in {result['seconds']}s"
+        print(f"{result['file']} [{result['sheet']}] -> {result['table']}: {status}")
+    return results
+
+# Worker processes re-import this module, so only run the load when executed directly
+if __name__ == '__main__':
+    # Database parameters for PostgreSQL
+    db_params = {
+        'database': 'postgres',
+        'user': 'postgres',
+        'password': '1234',
+        'host': 'localhost',
+        'port': '5432'  # Default PostgreSQL port
+    }
+
+    # Define the table name and the path to the Excel file
+    table_name = 'weather_data'
+    excel_file_path = r'C:\Users\Wissen\Downloads\weather_data.xlsx'
+    primary_key = 'city'  # Assuming 'city' is the primary key
+
+    # Remove any unwanted Unicode characters
+    excel_file_path = excel_file_path.replace('\u202a', '').replace('\u202b', '')
 
-# Database parameters for PostgreSQL
-db_params = {
-    'database': 'postgres',
-    'user': 'postgres',
-    'password': '1234',
-    'host': 'localhost',
-    'port': '5432'  # Default PostgreSQL port
-}
-
-# Define the table name and the path to the Excel file
-table_name = 'weather_data'
-excel_file_path = r'C:\Users\Wissen\Downloads\weather_data.xlsx'
-primary_key = 'city'  # Assuming 'city' is the primary key
-
-# Remove any unwanted Unicode characters
-excel_file_path = excel_file_path.replace('\u202a', '').replace('\u202b', '')
-
-# Call the function to create the table and ingest data
-load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key)
+    # Call the function to create the table and ingest data
+    load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key)
+    close_connection_pools()
 
 
 # In[ ]:
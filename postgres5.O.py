@@ -4,16 +4,53 @@
 # In[1]:
 
 
+import csv
+import hashlib
+import io
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
 import openpyxl
 import psycopg2
+from psycopg2 import errors, extensions, extras, pool
 from datetime import datetime
 
+# pandas is optional; without it changed rows are found with the row-by-row comparison
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Rows per COPY buffer when staging the sheet for a server-side diff
+COPY_CHUNK_SIZE = 10000
+
+# Optional fingerprint of the non-key columns, kept next to each row
+ROW_HASH_COLUMN = 'row_hash'
+# Keys per bulk lookup of stored rows or fingerprints
+KEY_LOOKUP_SIZE = 10000
+# Rows per UPDATE ... FROM (VALUES ...) statement
+UPDATE_PAGE_SIZE = 1000
+# Prepared UPDATE statements kept per connection, one per table and changed-column set;
+# 0 sends every page as a plain UPDATE ... FROM (VALUES ...) instead
+PREPARED_STATEMENT_CACHE_SIZE = 32
+
+# Table that receives ingestion timestamps when write_back='audit_table'
+INGESTION_AUDIT_TABLE = 'excel_ingestion_audit'
+
+# Append-only log of the old and new value of every column an update changed, per run id
+CHANGELOG_TABLE = 'excel_sync_changelog'
+# Bookkeeping columns that change on every update and are left out of the changelog
+CHANGELOG_SKIPPED_COLUMNS = (ROW_HASH_COLUMN, 'updated_timestamp', 'ingestion_timestamp')
+
 # Define the path to your Excel file
 excel_file_path = r'C:\Users\apranj\Downloads\weather_data.xlsx'
 excel_file_path = excel_file_path.replace('\u202a', '').replace('\u202b', '')
 
-# Load the workbook and select the active worksheet
-wb = openpyxl.load_workbook(excel_file_path)
+# Load the workbook in read-only mode and select the active worksheet
+wb = openpyxl.load_workbook(excel_file_path, read_only=True)
 ws = wb.active
 
 # Define the database connection parameters
@@ -41,22 +78,149 @@ def create_postgres_connection(db_params):
         print(f"Error connecting to PostgreSQL Database: {e}")
         return None
 
-conn = create_postgres_connection(db_params)
-if conn is None:
-    raise Exception("Unable to connect to the database.")
+# Pooled connections' cursors drop the schema cache when a table or column turns out to be
+# missing or already there: another process changed it since the cache was loaded
+SCHEMA_ERRORS = (errors.UndefinedTable, errors.DuplicateTable, errors.UndefinedColumn, errors.DuplicateColumn)
+
+class SchemaCheckingCursor(extensions.cursor):
+    def execute(self, query, vars=None):
+        try:
+            return super().execute(query, vars)
+        except SCHEMA_ERRORS:
+            invalidate_schema_cache(self.connection)
+            raise
+
+    def copy_expert(self, sql, file, size=8192):
+        try:
+            return super().copy_expert(sql, file, size)
+        except SCHEMA_ERRORS:
+            invalidate_schema_cache(self.connection)
+            raise
+
+# Connections are pooled per db_params and shared by every load in the process.
+# psycopg2 keeps at most POOL_MIN_CONNECTIONS idle connections between checkouts.
+POOL_MIN_CONNECTIONS = 2
+POOL_MAX_CONNECTIONS = 10
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_params, min_connections=POOL_MIN_CONNECTIONS, max_connections=POOL_MAX_CONNECTIONS):
+    pool_key = tuple(sorted(db_params.items()))
+    with _connection_pools_lock:
+        if pool_key not in _connection_pools:
+            connection_pool = pool.ThreadedConnectionPool(
+                min_connections,
+                max_connections,
+                dbname=db_params['database'],
+                user=db_params['user'],
+                password=db_params['password'],
+                host=db_params['host'],
+                port=db_params['port'],
+                cursor_factory=SchemaCheckingCursor
+            )
+            # getconn raises once the pool is exhausted, so checkouts wait for a slot first
+            _connection_pools[pool_key] = (connection_pool, threading.BoundedSemaphore(max_connections))
+            print("PostgreSQL connection pool created successfully.")
+        return _connection_pools[pool_key]
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        for connection_pool, _ in _connection_pools.values():
+            connection_pool.closeall()
+        _connection_pools.clear()
+
+def connection_is_healthy(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
 
-cur = conn.cursor()
+@contextmanager
+def postgres_session(db_params, statement_timeout=None):
+    # Check out a pooled connection, replacing it if it has gone stale, and hand it back
+    # with the session reset. statement_timeout is in milliseconds.
+    connection_pool, slots = get_connection_pool(db_params)
+    slots.acquire()
+    connection = None
+    try:
+        connection = connection_pool.getconn()
+        if not connection_is_healthy(connection):
+            connection_pool.putconn(connection, close=True)
+            connection = connection_pool.getconn()
+        if statement_timeout is not None:
+            with connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (statement_timeout,))
+            connection.commit()
+        yield connection
+    finally:
+        if connection is not None:
+            # reset() runs DISCARD ALL, which deallocates the session's prepared statements
+            forget_prepared_statements(connection)
+            try:
+                connection.reset()
+            except psycopg2.Error:
+                connection.close()
+            connection_pool.putconn(connection, close=bool(connection.closed))
+        slots.release()
 
 # PostgreSQL Functions
-def table_exists(connection, table_name):
+# Table metadata per database (keyed by DSN), preloaded from pg_catalog in one query.
+# Anything that runs DDL must call invalidate_schema_cache afterwards; pooled cursors also
+# drop it when a table turns out missing or already there because of another process's DDL.
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+def load_schema_cache(connection):
     try:
         with connection.cursor() as cursor:
-            cursor.execute("SELECT EXISTS (SELECT 1 FROM information_schema.tables WHERE table_name = %s)", (table_name,))
-            table_exists = cursor.fetchone()[0]
-        return table_exists
+            cursor.execute("""
+                SELECT c.relname, n.nspname, a.attname, format_type(a.atttypid, a.atttypmod), COALESCE(a.attnum = ANY(i.indkey), false)
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                LEFT JOIN pg_index i ON i.indrelid = c.oid AND i.indisprimary
+                WHERE c.relkind IN ('r', 'p', 'v', 'm', 'f') AND n.nspname = ANY(current_schemas(false))
+                ORDER BY array_position(current_schemas(false), n.nspname), c.relname, a.attnum
+            """)
+            catalog_rows = cursor.fetchall()
     except psycopg2.Error as e:
-        print(f"Error checking if table exists: {e}")
-        return False
+        print(f"Error loading table metadata: {e}")
+        connection.rollback()
+        return {}
+
+    # Tables earlier in the search path shadow same-named ones further along
+    schema = {}
+    table_schemas = {}
+    for table_name, schema_name, column_name, column_type, is_primary_key in catalog_rows:
+        if table_schemas.setdefault(table_name, schema_name) != schema_name:
+            continue
+        table = schema.setdefault(table_name, {'columns': {}, 'primary_key': []})
+        table['columns'][column_name] = column_type
+        if is_primary_key:
+            table['primary_key'].append(column_name)
+
+    with _schema_cache_lock:
+        _schema_cache[connection.dsn] = schema
+    return schema
+
+def get_table_schema(connection, table_name):
+    with _schema_cache_lock:
+        schema = _schema_cache.get(connection.dsn)
+    if schema is None:
+        schema = load_schema_cache(connection)
+    return schema.get(table_name.lower())
+
+def invalidate_schema_cache(connection):
+    with _schema_cache_lock:
+        _schema_cache.pop(connection.dsn, None)
+
+def table_exists(connection, table_name):
+    return get_table_schema(connection, table_name) is not None
 
 def create_table(connection, table_name, columns, primary_key):
     try:
@@ -66,87 +230,446 @@ def create_table(connection, table_name, columns, primary_key):
             create_table_sql = f"CREATE TABLE {table_name} ({columns_def}{primary_key_def})"
             cursor.execute(create_table_sql)
             connection.commit()
+            invalidate_schema_cache(connection)
             print(f"Table '{table_name}' created successfully.")
     except psycopg2.Error as e:
         print(f"Error creating table: {e}")
 
-def get_existing_columns(connection, table_name):
+def ensure_primary_key(connection, table_name, primary_key):
+    # Tables created elsewhere may lack the key the updates join on; add it unless the
+    # stored rows have duplicate or NULL keys. A different existing primary key gets a
+    # unique index on primary_key instead.
+    table = get_table_schema(connection, table_name)
+    if table is None or table['primary_key'] == [primary_key]:
+        return
     try:
         with connection.cursor() as cursor:
-            cursor.execute(f"SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table_name,))
-            existing_columns = [row[0] for row in cursor.fetchall()]
-        return existing_columns
+            # A unique index on the key alone is enough, and spares the duplicate scan
+            cursor.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_index i
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = to_regclass(%s) AND i.indisunique AND i.indisvalid
+                      AND i.indnatts = 1 AND i.indpred IS NULL AND a.attname = %s
+                )
+            """, (table_name, primary_key))
+            if cursor.fetchone()[0]:
+                connection.rollback()
+                return
+            cursor.execute(f'SELECT "{primary_key}", count(*) FROM {table_name} GROUP BY 1 HAVING count(*) > 1 OR "{primary_key}" IS NULL LIMIT 5')
+            duplicates = cursor.fetchall()
+            if duplicates:
+                print(f"Cannot add a key on '{table_name}.{primary_key}', it has duplicate or NULL values: {duplicates}")
+                connection.rollback()
+                return
+            if table['primary_key']:
+                cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_{primary_key}_key ON {table_name} ("{primary_key}")')
+            else:
+                cursor.execute(f'ALTER TABLE {table_name} ADD PRIMARY KEY ("{primary_key}")')
+            connection.commit()
+            invalidate_schema_cache(connection)
+            print(f"Added key ({primary_key}) to table '{table_name}'.")
     except psycopg2.Error as e:
-        print(f"Error retrieving existing columns: {e}")
-        return []
+        print(f"Error adding key to table: {e}")
+        connection.rollback()
+
+def get_existing_columns(connection, table_name):
+    table = get_table_schema(connection, table_name)
+    return list(table['columns']) if table else []
 
 def alter_table(connection, table_name, columns):
     try:
         with connection.cursor() as cursor:
-            existing_columns = get_existing_columns(connection, table_name)
+            existing_columns = {col.lower() for col in get_existing_columns(connection, table_name)}
+            added_columns = False
             for column in columns:
-                if column.lower() not in [col.lower() for col in existing_columns]:
-                    alter_sql = f"ALTER TABLE {table_name} ADD COLUMN {column} VARCHAR(255)"
+                if column.lower() not in existing_columns:
+                    # IF NOT EXISTS: another process may have added it since the schema cache was loaded
+                    alter_sql = f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column} VARCHAR(255)"
                     cursor.execute(alter_sql)
+                    existing_columns.add(column.lower())
+                    added_columns = True
                     print(f"Altered table '{table_name}' to add column '{column}'.")
             connection.commit()
+            if added_columns:
+                invalidate_schema_cache(connection)
     except psycopg2.Error as e:
         print(f"Error altering table: {e}")
         connection.rollback()
 
-def fetch_existing_data(connection, table_name, primary_key):
+def table_has_rows(connection, table_name):
     try:
         with connection.cursor() as cursor:
-            cursor.execute(f"SELECT * FROM {table_name} ORDER BY {primary_key}")
-            rows = cursor.fetchall()
-            columns = [desc[0] for desc in cursor.description]
-        data_dict = {row[columns.index(primary_key)]: row for row in rows}
-        return data_dict, columns
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table_name})")
+            has_rows = cursor.fetchone()[0]
+        return has_rows
     except psycopg2.Error as e:
-        print(f"Error fetching existing data: {e}")
-        return {}, []
+        print(f"Error checking for existing rows: {e}")
+        connection.rollback()
+        return False
 
-def update_data_in_postgres(connection, table_name, columns, data, primary_key, exclude_columns=['ingestion_timestamp']):
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_buffer(rows):
+    # NULL is spelled \N so empty strings survive the round trip
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if cell is None else str(cell).lower() if isinstance(cell, bool) else cell for cell in row])
+    buffer.seek(0)
+    return buffer
+
+def fetch_changed_rows(connection, table_name, columns, data, primary_key, exclude_columns=['ingestion_timestamp'], chunk_size=COPY_CHUNK_SIZE, return_rows=False):
+    # The sheet is COPYed into a temp table and compared with IS DISTINCT FROM, so only
+    # the indexes (into data) of changed rows and of keys missing from the table come back.
+    # With return_rows the staged values come back too, as (index, row) pairs, so data
+    # can be a one-pass stream
+    try:
+        with connection.cursor() as cursor:
+            stage_table = f"{table_name}_diff"
+            stage_columns = ', '.join([f'"{col}"' for col in columns])
+            compare_columns = [col for col in columns if col != primary_key and col not in exclude_columns]
+
+            cursor.execute(f"CREATE TEMP TABLE {stage_table} (LIKE {table_name}, sheet_row_number BIGSERIAL) ON COMMIT DROP")
+            copy_sql = f"COPY {stage_table} ({stage_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+            for chunk in chunked(data, chunk_size):
+                cursor.copy_expert(copy_sql, csv_buffer(chunk))
+
+            changed_filter = ''
+            if compare_columns:
+                target_values = ', '.join([f't."{col}"' for col in compare_columns])
+                stage_values = ', '.join([f's."{col}"' for col in compare_columns])
+                changed_filter = f' OR ({target_values}) IS DISTINCT FROM ({stage_values})'
+
+            row_values = ''.join([f', s."{col}"' for col in columns]) if return_rows else ''
+            cursor.execute(f"""
+                SELECT s.sheet_row_number - 1, t."{primary_key}" IS NULL{row_values}
+                FROM {stage_table} s
+                LEFT JOIN {table_name} t ON t."{primary_key}" = s."{primary_key}"
+                WHERE t."{primary_key}" IS NULL{changed_filter}
+                ORDER BY s.sheet_row_number
+            """)
+            changed_rows = []
+            missing_rows = []
+            for row_idx, missing, *values in cursor:
+                entry = (row_idx, values) if return_rows else row_idx
+                if missing:
+                    missing_rows.append(entry)
+                else:
+                    changed_rows.append(entry)
+        connection.commit()
+        return changed_rows, missing_rows
+    except psycopg2.Error as e:
+        print(f"Error computing changed rows: {e}")
+        connection.rollback()
+        return [], []
+
+def get_column_types(connection, table_name):
+    table = get_table_schema(connection, table_name)
+    return dict(table['columns']) if table else {}
+
+# Statement names per connection in least recently used order, keyed by statement shape.
+# They last for one postgres_session: the pool's connection.reset() runs DISCARD ALL,
+# so the session forgets them before handing the connection back.
+_prepared_statements = weakref.WeakKeyDictionary()
+_prepared_statements_lock = threading.Lock()
+_prepared_statement_ids = count(1)
+
+def forget_prepared_statements(connection):
+    with _prepared_statements_lock:
+        _prepared_statements.pop(connection, None)
+
+def update_statement(table_name, key_column, set_columns, value_types, arrays, run_id=None):
+    # UPDATE from one unnested array per column in set_columns + [key_column], cast to
+    # value_types. With run_id, the same statement also appends the old and new value of
+    # every column it changed to CHANGELOG_TABLE; the old values are read (and locked) from
+    # the statement's snapshot before the update, so both sides come from the same rows.
+    value_columns = set_columns + [key_column]
+    assignments = ', '.join([f'"{col}" = v."{col}"::{value_type}' for col, value_type in zip(set_columns, value_types)])
+    array_columns = ', '.join([f'"{col}"' for col in value_columns])
+    key_match = f'"{key_column}" = v."{key_column}"::{value_types[-1]}'
+    if run_id is None:
+        return f"""
+            UPDATE {table_name} AS t SET {assignments}
+            FROM unnest({', '.join(arrays)}) AS v ({array_columns})
+            WHERE t.{key_match}
+        """
+
+    logged_columns = [col for col in set_columns if col not in CHANGELOG_SKIPPED_COLUMNS]
+    changes = ', '.join([f"""('{col}', old_rows."{col}"::text, new_rows."{col}"::text)""" for col in logged_columns])
+    return f"""
+        WITH v AS (SELECT * FROM unnest({', '.join(arrays)}) AS v ({array_columns})),
+        old_rows AS (SELECT {', '.join([f't."{col}"' for col in [key_column] + logged_columns])}
+                     FROM {table_name} AS t JOIN v ON t.{key_match} FOR UPDATE OF t),
+        new_rows AS (UPDATE {table_name} AS t SET {assignments} FROM v WHERE t.{key_match}
+                     RETURNING {', '.join([f't."{col}"' for col in [key_column] + logged_columns])})
+        INSERT INTO {CHANGELOG_TABLE} (run_id, table_name, row_key, column_name, old_value, new_value)
+        SELECT {run_id}, '{table_name}', new_rows."{key_column}"::text, c.column_name, c.old_value, c.new_value
+        FROM new_rows JOIN old_rows ON old_rows."{key_column}" = new_rows."{key_column}"
+        CROSS JOIN LATERAL (VALUES {changes}) AS c (column_name, old_value, new_value)
+        WHERE c.old_value IS DISTINCT FROM c.new_value
+    """
+
+def prepared_update(cursor, table_name, key_column, set_columns, column_types, cache_size=PREPARED_STATEMENT_CACHE_SIZE, changelog=False):
+    # Returns the name of a prepared UPDATE taking one text[] per column in set_columns +
+    # [key_column]; the arrays are unnested and cast, so any number of rows fits one EXECUTE.
+    # With changelog the statement takes the run id as one more text parameter.
+    # The least recently used statement is deallocated once the connection has cache_size.
+    value_types = tuple(column_types.get(col, 'text') for col in set_columns + [key_column])
+    shape = (table_name, key_column, tuple(set_columns), value_types, changelog)
+    with _prepared_statements_lock:
+        statements = _prepared_statements.setdefault(cursor.connection, OrderedDict())
+        if shape in statements:
+            statements.move_to_end(shape)
+            return statements[shape]
+        evicted = statements.popitem(last=False)[1] if len(statements) >= cache_size else None
+
+    if evicted is not None:
+        cursor.execute(f"DEALLOCATE {evicted}")
+    statement_name = f"excel_update_{next(_prepared_statement_ids)}"
+    array_count = len(set_columns) + 1
+    parameter_types = ', '.join(['text[]'] * array_count + (['text'] if changelog else []))
+    arrays = [f'${i + 1}' for i in range(array_count)]
+    run_id = f'${array_count + 1}' if changelog else None
+    cursor.execute(f"PREPARE {statement_name} ({parameter_types}) AS " +
+                   update_statement(table_name, key_column, set_columns, value_types, arrays, run_id))
+    with _prepared_statements_lock:
+        _prepared_statements[cursor.connection][shape] = statement_name
+    return statement_name
+
+def batch_update(cursor, table_name, key_column, set_columns, rows, column_types, page_size=UPDATE_PAGE_SIZE,
+                 cache_size=PREPARED_STATEMENT_CACHE_SIZE, changelog_run_id=None):
+    # rows are [*set_values, key]. Each page is sent as column arrays to the prepared UPDATE
+    # for this shape, or without the cache as one UPDATE ... FROM (VALUES ...); either way
+    # every value is cast to its column type so the join and assignments are typed.
+    # With changelog_run_id the changed values are logged to CHANGELOG_TABLE by the same
+    # statement, so the log commits or rolls back with the update itself.
+    changelog = changelog_run_id is not None and any(col not in CHANGELOG_SKIPPED_COLUMNS for col in set_columns)
+    array_parameters = ['%s::text[]'] * (len(set_columns) + 1)
+    if cache_size:
+        statement_name = prepared_update(cursor, table_name, key_column, set_columns, column_types, cache_size, changelog)
+        update_sql = f"EXECUTE {statement_name} ({', '.join(array_parameters + (['%s'] if changelog else []))})"
+    elif changelog:
+        value_types = [column_types.get(col, 'text') for col in set_columns + [key_column]]
+        update_sql = update_statement(table_name, key_column, set_columns, value_types, array_parameters, '%s::text')
+    if cache_size or changelog:
+        for page in chunked(rows, page_size):
+            arrays = [[None if value is None else str(value) for value in values] for values in zip(*page)]
+            cursor.execute(update_sql, arrays + ([changelog_run_id] if changelog else []))
+        return
+
+    assignments = ', '.join([f'"{col}" = v."{col}"' for col in set_columns])
+    value_columns = ', '.join([f'"{col}"' for col in set_columns + [key_column]])
+    template = '(' + ', '.join([f"%s::{column_types.get(col, 'text')}" for col in set_columns + [key_column]]) + ')'
+    update_sql = f'UPDATE {table_name} AS t SET {assignments} FROM (VALUES %s) AS v ({value_columns}) WHERE t."{key_column}" = v."{key_column}"'
+    extras.execute_values(cursor, update_sql, rows, template=template, page_size=page_size)
+
+def new_run_id():
+    # Labels a run's changes. Runs overlap, so it orders runs by start, not by commit;
+    # read the changelog incrementally with read_changelog, not with run_id > last seen.
+    return datetime.now().strftime('%Y%m%dT%H%M%S%f')
+
+def ensure_changelog_table(connection):
+    if 'txid' in get_column_types(connection, CHANGELOG_TABLE):
+        return
     try:
         with connection.cursor() as cursor:
-            for row in data:
-                key = row[columns.index(primary_key)]
-                
-                # Select the current row from the database
-                select_sql = f'SELECT {", ".join(columns)} FROM {table_name} WHERE {primary_key} = %s'
-                cursor.execute(select_sql, (key,))
-                current_row = cursor.fetchone()
-                
-                # Check if the current row exists
-                if current_row is None:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {CHANGELOG_TABLE} (
+                    change_id BIGSERIAL PRIMARY KEY,
+                    run_id TEXT NOT NULL,
+                    table_name TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    column_name TEXT NOT NULL,
+                    old_value TEXT,
+                    new_value TEXT,
+                    changed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    txid BIGINT NOT NULL DEFAULT txid_current()
+                )
+            """)
+            # Changelogs created before the txid watermark existed
+            cursor.execute(f"ALTER TABLE {CHANGELOG_TABLE} ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT txid_current()")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {CHANGELOG_TABLE}_run_idx ON {CHANGELOG_TABLE} (table_name, run_id)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {CHANGELOG_TABLE}_txid_idx ON {CHANGELOG_TABLE} (table_name, txid)")
+            connection.commit()
+            invalidate_schema_cache(connection)
+    except psycopg2.Error as e:
+        print(f"Error creating changelog table: {e}")
+        connection.rollback()
+
+def read_changelog(connection, table_name, after_txid=0):
+    # Returns the changes to table_name logged since the after_txid watermark, oldest first,
+    # and the watermark to pass next time. Each change carries the id of the transaction
+    # that wrote it, and reads stop below the oldest transaction still running, so a run
+    # that started earlier but commits later is picked up by the next read, not skipped.
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+            watermark = cursor.fetchone()[0]
+            cursor.execute(f"""
+                SELECT run_id, row_key, column_name, old_value, new_value, changed_at FROM {CHANGELOG_TABLE}
+                WHERE table_name = %s AND txid >= %s AND txid < %s ORDER BY txid, change_id
+            """, (table_name, after_txid, watermark))
+            changes = cursor.fetchall()
+        connection.commit()
+        return changes, watermark
+    except psycopg2.Error as e:
+        print(f"Error reading changelog: {e}")
+        connection.rollback()
+        return [], after_txid
+
+def row_fingerprint(row, columns, primary_key, exclude_columns=['ingestion_timestamp']):
+    values = ['\\N' if row[i] is None else str(row[i]) for i, col in enumerate(columns) if col != primary_key and col not in exclude_columns]
+    return hashlib.md5('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+def ensure_row_hash_column(connection, table_name):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {ROW_HASH_COLUMN} CHAR(32)")
+            connection.commit()
+            invalidate_schema_cache(connection)
+    except psycopg2.Error as e:
+        print(f"Error adding row hash column: {e}")
+        connection.rollback()
+
+def update_data_with_row_hash(connection, table_name, columns, data, primary_key, exclude_columns=['ingestion_timestamp'], changelog_run_id=None):
+    # Compare one stored fingerprint per key instead of every column of every row;
+    # rows without a stored hash yet are rewritten once so the hash gets filled in.
+    # data is consumed in chunks of KEY_LOOKUP_SIZE, so it can be a one-pass stream
+    try:
+        key_index = columns.index(primary_key)
+        update_columns = [col for col in columns if col != primary_key and col not in exclude_columns]
+        update_indices = [columns.index(col) for col in update_columns]
+        column_types = get_column_types(connection, table_name)
+        key_type = column_types.get(primary_key, 'text')
+
+        row_count = 0
+        updated_count = 0
+        with connection.cursor() as cursor:
+            for chunk in chunked(data, KEY_LOOKUP_SIZE):
+                cursor.execute(f"SELECT {primary_key}, {ROW_HASH_COLUMN} FROM {table_name} WHERE {primary_key} = ANY(%s::{key_type}[])",
+                               ([str(row[key_index]) for row in chunk],))
+                stored_hashes = {str(key): row_hash for key, row_hash in cursor.fetchall()}
+
+                update_rows = []
+                for row in chunk:
+                    key = str(row[key_index])
+                    if key not in stored_hashes:
+                        print(f"Record with {primary_key} = {key} not found.")
+                        continue
+                    row_hash = row_fingerprint(row, columns, primary_key, exclude_columns)
+                    if stored_hashes[key] != row_hash:
+                        update_rows.append([str(row[i]) for i in update_indices] + [row_hash, key])
+
+                if update_rows:
+                    batch_update(cursor, table_name, primary_key, update_columns + [ROW_HASH_COLUMN], update_rows, column_types,
+                                 changelog_run_id=changelog_run_id)
+                row_count += len(chunk)
+                updated_count += len(update_rows)
+
+        connection.commit()
+        print(f"Data updated successfully ({updated_count} changed of {row_count} rows).")
+    except psycopg2.Error as e:
+        print(f"Error updating data: {e}")
+        connection.rollback()
+
+def group_changed_rows(columns, chunk, current_rows, primary_key, exclude_columns):
+    # Compare each column value and group the changed rows by which columns differ,
+    # so every group shares one statement shape. Returns the groups and the missing keys.
+    key_index = columns.index(primary_key)
+    update_groups = {}
+    missing_keys = []
+    for row in chunk:
+        key = str(row[key_index])
+        current_row = current_rows.get(key)
+        if current_row is None:
+            missing_keys.append(key)
+            continue
+
+        changed_columns = tuple(col for i, col in enumerate(columns)
+                                if col != primary_key and col not in exclude_columns and str(current_row[i]) != str(row[i]))
+        if changed_columns:
+            update_values = [str(row[columns.index(col)]) for col in changed_columns]
+            update_groups.setdefault(changed_columns, []).append(update_values + [key])
+    return update_groups, missing_keys
+
+def normalize_frame(frame):
+    # str() of every value, with missing values spelled 'None' like str(None)
+    return frame.astype(object).where(frame.notna(), 'None').astype(str)
+
+def group_changed_rows_columnar(columns, chunk, current_rows, primary_key, exclude_columns):
+    # Same result as group_changed_rows, but values are normalized with str() and compared
+    # one whole column at a time, and rows are grouped by their changed-column pattern
+    # with a pandas groupby instead of a Python loop per cell
+    compare_columns = [col for col in columns if col != primary_key and col not in exclude_columns]
+    sheet = normalize_frame(pd.DataFrame(chunk, columns=columns, dtype=object)[[primary_key] + compare_columns])
+    current = normalize_frame(pd.DataFrame(list(current_rows.values()), columns=columns, dtype=object)[[primary_key] + compare_columns])
+
+    merged = sheet.merge(current, on=primary_key, how='left', suffixes=('', '_db'), indicator=True)
+    missing_keys = merged.loc[merged['_merge'] == 'left_only', primary_key].tolist()
+    merged = merged[merged['_merge'] == 'both']
+    if not compare_columns or merged.empty:
+        return {}, missing_keys
+
+    new_values = merged[compare_columns]
+    changed = pd.DataFrame(new_values.values != merged[[col + '_db' for col in compare_columns]].values,
+                           index=merged.index, columns=compare_columns)
+
+    update_groups = {}
+    for pattern, group in changed.groupby(compare_columns, sort=False):
+        pattern = pattern if isinstance(pattern, tuple) else (pattern,)
+        changed_columns = tuple(col for col, is_changed in zip(compare_columns, pattern) if is_changed)
+        if changed_columns:
+            update_rows = new_values.loc[group.index, list(changed_columns)]
+            update_rows[primary_key] = merged.loc[group.index, primary_key]
+            update_groups[changed_columns] = update_rows.values.tolist()
+    return update_groups, missing_keys
+
+def update_data_in_postgres(connection, table_name, columns, data, primary_key, exclude_columns=['ingestion_timestamp'], page_size=UPDATE_PAGE_SIZE,
+                            columnar=True, changelog_run_id=None):
+    try:
+        key_index = columns.index(primary_key)
+        column_types = get_column_types(connection, table_name)
+        select_sql = f'SELECT {", ".join(columns)} FROM {table_name} WHERE {primary_key} = ANY(%s::{column_types.get(primary_key, "text")}[])'
+        updated_count = 0
+
+        with connection.cursor() as cursor:
+            for chunk in chunked(data, KEY_LOOKUP_SIZE):
+                # Select the current rows for the whole chunk at once
+                cursor.execute(select_sql, ([str(row[key_index]) for row in chunk],))
+                current_rows = {str(current_row[key_index]): current_row for current_row in cursor.fetchall()}
+
+                if columnar and pd is not None:
+                    update_groups, missing_keys = group_changed_rows_columnar(columns, chunk, current_rows, primary_key, exclude_columns)
+                else:
+                    update_groups, missing_keys = group_changed_rows(columns, chunk, current_rows, primary_key, exclude_columns)
+                for key in missing_keys:
                     print(f"Record with {primary_key} = {key} not found.")
-                    continue
-                
-                # Compare each column value
-                update_needed = False
-                update_set = []
-                update_values = []
-                for i, col in enumerate(columns):
-                    if col != primary_key and col not in exclude_columns:
-                        db_value = str(current_row[i])
-                        new_value = str(row[columns.index(col)])
-                        if db_value != new_value:
-                            update_needed = True
-                            update_set.append(f'"{col}" = %s')
-                            update_values.append(new_value)
-                
-                if update_needed:
-                    update_sql = f'UPDATE {table_name} SET {", ".join(update_set)} WHERE {primary_key} = %s'
-                    cursor.execute(update_sql, update_values + [key])
-                    
+
+                for changed_columns, update_rows in update_groups.items():
+                    batch_update(cursor, table_name, primary_key, list(changed_columns), update_rows, column_types, page_size,
+                                 changelog_run_id=changelog_run_id)
+                    updated_count += len(update_rows)
+
             connection.commit()
-            print("Data updated successfully.")
+            print(f"Data updated successfully ({updated_count} rows).")
     except psycopg2.Error as e:
         print(f"Error updating data: {e}")
         connection.rollback()
 
-def insert_data_into_postgres(connection, table_name, columns, data, primary_key):
+def insert_data_into_postgres(connection, table_name, columns, data, primary_key, use_row_hash=False):
     try:
+        if use_row_hash:
+            data = (list(row) + [row_fingerprint(row, columns, primary_key)] for row in data)
+            columns = columns + [ROW_HASH_COLUMN]
         with connection.cursor() as cursor:
             insert_sql = f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES ({", ".join(["%s"] * len(columns))})'
             cursor.executemany(insert_sql, data)
@@ -156,151 +679,185 @@ def insert_data_into_postgres(connection, table_name, columns, data, primary_key
         print(f"Error inserting data: {e}")
         connection.rollback()
 
-def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key):
+def read_excel_rows(excel_file_path):
+    # Read-only mode parses the sheet lazily; the returned generator yields one row at a
+    # time, without the dynamic timestamp columns, and closes the workbook once exhausted
+    wb = openpyxl.load_workbook(excel_file_path, read_only=True)
+    ws = wb.active
+    headers = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
+    # Exclude any dynamic timestamp columns from the database schema
+    column_indices = [i for i, col in enumerate(headers) if not col.startswith('2024-')]
+    columns = [headers[i] for i in column_indices]
+
+    def typed_rows():
+        try:
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                yield [row[i] for i in column_indices]
+        finally:
+            wb.close()
+
+    return columns, typed_rows()
+
+def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key, server_diff=True, use_row_hash=False, statement_timeout=None,
+                                  changelog=False):
+    # With changelog, every changed value is appended to CHANGELOG_TABLE under one run id
+    # per call, which is returned so the caller can hand it to downstream consumers
+    run_id = new_run_id() if changelog else None
     try:
-        wb = openpyxl.load_workbook(excel_file_path)
-        ws = wb.active
-        print("Excel file read successfully.")
-
-        columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
-        # Exclude any dynamic timestamp columns from the database schema
-        columns = [col for col in columns if not col.startswith('2024-')]
-        data = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            data.append(row)
-
-        connection = create_postgres_connection(db_params)
-        if connection is None:
-            return
-
-        if not table_exists(connection, table_name):
-            create_table(connection, table_name, columns, primary_key)
-        else:
-            alter_table(connection, table_name, columns)
-
-        existing_data, existing_columns = fetch_existing_data(connection, table_name, primary_key)
-        if existing_data:
-            update_data_in_postgres(connection, table_name, columns, data, primary_key)
-        else:
-            insert_data_into_postgres(connection, table_name, columns, data, primary_key)
-
-        connection.close()
+        columns, data = read_excel_rows(excel_file_path)
+        print("Excel file opened for streaming.")
+
+        with postgres_session(db_params, statement_timeout) as connection:
+            if not table_exists(connection, table_name):
+                create_table(connection, table_name, columns, primary_key)
+            else:
+                alter_table(connection, table_name, columns)
+                ensure_primary_key(connection, table_name, primary_key)
+
+            if use_row_hash:
+                ensure_row_hash_column(connection, table_name)
+            if changelog:
+                ensure_changelog_table(connection)
+
+            if table_has_rows(connection, table_name):
+                if use_row_hash:
+                    update_data_with_row_hash(connection, table_name, columns, data, primary_key, changelog_run_id=run_id)
+                else:
+                    if server_diff:
+                        changed_rows, missing_rows = fetch_changed_rows(connection, table_name, columns, data, primary_key, return_rows=True)
+                        for _, row in missing_rows:
+                            print(f"Record with {primary_key} = {row[columns.index(primary_key)]} not found.")
+                        data = [row for _, row in changed_rows]
+                    update_data_in_postgres(connection, table_name, columns, data, primary_key, changelog_run_id=run_id)
+            else:
+                insert_data_into_postgres(connection, table_name, columns, data, primary_key, use_row_hash)
     except Exception as e:
         print(f"Error loading Excel data into PostgreSQL: {e}")
+    return run_id
 
 # Update Excel File with Timestamp
-def update_excel_with_timestamp(file_path, updated_rows):
-    workbook = openpyxl.load_workbook(file_path)
+def update_excel_with_timestamp(file_path, updated_rows, workbook=None, write_back='xlsx', connection=None, run_timestamp=None):
+    # write_back is 'xlsx' to stamp the rows in the workbook itself, 'sidecar' to append the
+    # row-to-timestamp mapping to a CSV next to it, or 'audit_table' to insert it into
+    # INGESTION_AUDIT_TABLE through connection. A writable workbook that is already
+    # loaded can be passed in so it isn't read again. Pass the run_timestamp the rows were
+    # stamped with in the database so both sides agree; it defaults to now.
+    run_timestamp = run_timestamp or datetime.now()
+    sheet_rows = [row_index for row_index, _ in updated_rows]
+
+    if write_back == 'sidecar':
+        write_timestamp_sidecar(file_path, sheet_rows, run_timestamp)
+        return
+    if write_back == 'audit_table':
+        write_timestamp_audit(connection, file_path, sheet_rows, run_timestamp)
+        return
+
+    if workbook is None or getattr(workbook, 'read_only', False):
+        workbook = openpyxl.load_workbook(file_path)
     sheet = workbook.active
     timestamp_header = "Ingestion Timestamp"
     timestamp_column = None
 
     # Find or create the timestamp column
-    for col in range(1, sheet.max_column + 1):
-        if sheet.cell(row=1, column=col).value == timestamp_header:
-            timestamp_column = col
+    for cell in sheet[1]:
+        if cell.value == timestamp_header:
+            timestamp_column = cell.column
             break
 
     if timestamp_column is None:
         timestamp_column = sheet.max_column + 1
         sheet.cell(row=1, column=timestamp_column).value = timestamp_header
 
-    # Update timestamp for only changed rows
-    for row_index, _ in updated_rows:
-        sheet.cell(row=row_index, column=timestamp_column).value = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Update timestamp for only changed rows, all with the run's timestamp
+    timestamp_value = run_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    for sheet_row in sheet_rows:
+        sheet.cell(row=sheet_row, column=timestamp_column).value = timestamp_value
 
     workbook.save(file_path)
 
-# Fetch existing data from the database, ordered by 'city'
-cur.execute("SELECT * FROM weather_data ORDER BY city;")
-db_data = cur.fetchall()
-
-# Convert database data to a dictionary for quick lookup
-column_names = [desc[0].lower() for desc in cur.description]
-db_data_dict = {row[0]: row for row in db_data}
-
-# Get Excel column names
-excel_headers = [cell.value for cell in ws[1]]
-excel_headers_normalized = [header.strip().lower() for header in excel_headers]
-
-# Determine the index of the unique identifier column in Excel (assuming 'city' is the unique identifier)
-unique_col_index = excel_headers_normalized.index('city')
-
-# Find common columns between Excel and database
-common_columns = set(excel_headers_normalized) & set(column_names)
-
-if not common_columns:
-    raise ValueError("No common columns between Excel headers and database columns.")
-
-# Determine which columns to update
-update_columns = [col for col in column_names if col in common_columns and col != 'city']
-update_indices = [excel_headers_normalized.index(col) for col in update_columns]
-
-# Prepare the SQL update query
-set_clause = ", ".join([f"{col} = %s" for col in update_columns])
-update_query = f"UPDATE weather_data SET {set_clause}, updated_timestamp = %s WHERE city = %s"
-
-# Iterate through the rows in the Excel file, starting from the second row
-rows_to_update = []
-for row_index, row in enumerate(ws.iter_rows(min_row=2, values_only=True)):
-    city = row[unique_col_index]
-    if city in db_data_dict:
-        db_row = db_data_dict[city]
-        update_values = [row[idx] for idx in update_indices]
-
-        # Check for differences
-        if any(str(row[idx]) != str(db_row[column_names.index(col)]) for col, idx in zip(update_columns, update_indices)):
-            updated_timestamp = datetime.now()
-            update_values.append(updated_timestamp)
-            update_values.append(city)
-            rows_to_update.append((row_index + 2, tuple(update_values)))
-    else:
-        print(f"City {city} not found in the database.")
-
-# Update only the changed rows in the database
-for _, row in rows_to_update:
-    cur.execute(update_query, row)
-
-# Commit the changes and close the connection
-conn.commit()
-cur.close()
-conn.close()
-
-print(f"Rows updated: {len(rows_to_update)}")
-
-# Update Excel File with Timestamp
-def update_excel_with_timestamp(file_path, updated_rows):
-    workbook = openpyxl.load_workbook(file_path)
-    sheet = workbook.active
-    timestamp_header = "Ingestion Timestamp"
-    timestamp_column = None
-
-    # Find or create the timestamp column
-    for col in range(1, sheet.max_column + 1):
-        if sheet.cell(row=1, column=col).value == timestamp_header:
-            timestamp_column = col
-            break
-
-    if timestamp_column is None:
-        timestamp_column = sheet.max_column + 1
-        sheet.cell(row=1, column=timestamp_column).value = timestamp_header
+def write_timestamp_sidecar(file_path, sheet_rows, run_timestamp):
+    sidecar_path = f"{file_path}.ingestion.csv"
+    new_file = not os.path.exists(sidecar_path)
+    timestamp_value = run_timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    with open(sidecar_path, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['sheet_row', 'ingestion_timestamp'])
+        writer.writerows([(sheet_row, timestamp_value) for sheet_row in sheet_rows])
+
+def write_timestamp_audit(connection, file_path, sheet_rows, run_timestamp):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {INGESTION_AUDIT_TABLE} (source TEXT, sheet_row INTEGER, ingested_at TIMESTAMP)")
+            extras.execute_values(cursor, f"INSERT INTO {INGESTION_AUDIT_TABLE} (source, sheet_row, ingested_at) VALUES %s",
+                                  [(file_path, sheet_row, run_timestamp) for sheet_row in sheet_rows])
+            connection.commit()
+            invalidate_schema_cache(connection)
+    except psycopg2.Error as e:
+        print(f"Error writing ingestion audit rows: {e}")
+        connection.rollback()
 
-    # Update timestamp for only changed rows
-    for row_index, _ in updated_rows:
-        sheet.cell(row=row_index, column=timestamp_column).value = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Check out a pooled connection for the weather_data sync; the changed values are logged
+# to the changelog under this run's id in the same transaction as the update
+sync_run_id = new_run_id()
+# One timestamp for the whole run, in the database and in the workbook alike
+sync_timestamp = datetime.now()
+with postgres_session(db_params) as conn:
+    ensure_changelog_table(conn)
+    # Fetch only the column names and types, the rows themselves are compared on the server
+    column_types = get_column_types(conn, 'weather_data')
+    column_names = [col.lower() for col in column_types]
+
+    # Get Excel column names
+    excel_headers = [cell.value for cell in ws[1]]
+    excel_headers_normalized = [header.strip().lower() for header in excel_headers]
+
+    # Determine the index of the unique identifier column in Excel (assuming 'city' is the unique identifier)
+    unique_col_index = excel_headers_normalized.index('city')
+
+    # Find common columns between Excel and database
+    common_columns = set(excel_headers_normalized) & set(column_names)
+
+    if not common_columns:
+        raise ValueError("No common columns between Excel headers and database columns.")
+
+    # Determine which columns to update
+    update_columns = [col for col in column_names if col in common_columns and col != 'city']
+    update_indices = [excel_headers_normalized.index(col) for col in update_columns]
+
+    # Stream the city and compared columns of every Excel row to the server and let PostgreSQL
+    # find the differences; only the changed rows come back, as [city, *update_columns]
+    diff_rows = ([row[unique_col_index]] + [row[idx] for idx in update_indices] for row in ws.iter_rows(min_row=2, values_only=True))
+    changed_rows, missing_rows = fetch_changed_rows(conn, 'weather_data', ['city'] + update_columns, diff_rows, 'city', exclude_columns=[], return_rows=True)
+    wb.close()
+
+    for _, row in missing_rows:
+        print(f"City {row[0]} not found in the database.")
+
+    rows_to_update = []
+    for row_index, row in changed_rows:
+        update_values = row[1:]
+        update_values.append(sync_timestamp)
+        update_values.append(row[0])
+        rows_to_update.append((row_index + 2, tuple(update_values)))
+
+    # Update only the changed rows in the database, a page of rows per statement
+    with conn.cursor() as cur:
+        batch_update(cur, 'weather_data', 'city', update_columns + ['updated_timestamp'], [row for _, row in rows_to_update], column_types,
+                     changelog_run_id=sync_run_id)
+
+    # Commit the changes, the connection goes back to the pool
+    conn.commit()
 
-    workbook.save(file_path)
+print(f"Rows updated: {len(rows_to_update)}")
+close_connection_pools()
 
 # Run the data load and update process
 table_name = 'weather_data2'
 primary_key = 'city'
 
 # Ensure that the Excel file is updated with the timestamps
-update_excel_with_timestamp(excel_file_path, [(row_index, _) for row_index, _ in rows_to_update])
+update_excel_with_timestamp(excel_file_path, [(row_index, _) for row_index, _ in rows_to_update], run_timestamp=sync_timestamp)
 
 
 # In[ ]:
-
-
-
-
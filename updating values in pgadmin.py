@@ -4,10 +4,19 @@
 # In[2]:
 
 
+import csv
+import io
+import threading
+from contextlib import contextmanager
+from itertools import chain, islice
 import psycopg2
+from psycopg2 import errors, extras, pool
 from openpyxl import load_workbook
 import datetime  # Ensure datetime module is imported
 
+# Rows per COPY buffer / INSERT page when bulk loading a new table
+COPY_CHUNK_SIZE = 10000
+
 def create_postgres_connection(db_params):
     try:
         connection = psycopg2.connect(
@@ -23,6 +32,74 @@ def create_postgres_connection(db_params):
         print(f"Error connecting to PostgreSQL Database: {e}")
         return None
 
+# Connections are pooled per db_params and shared by every load in the process.
+# psycopg2 keeps at most POOL_MIN_CONNECTIONS idle connections between checkouts.
+POOL_MIN_CONNECTIONS = 2
+POOL_MAX_CONNECTIONS = 10
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_params, min_connections=POOL_MIN_CONNECTIONS, max_connections=POOL_MAX_CONNECTIONS):
+    pool_key = tuple(sorted(db_params.items()))
+    with _connection_pools_lock:
+        if pool_key not in _connection_pools:
+            connection_pool = pool.ThreadedConnectionPool(
+                min_connections,
+                max_connections,
+                dbname=db_params['database'],
+                user=db_params['user'],
+                password=db_params['password'],
+                host=db_params['host'],
+                port=db_params['port']
+            )
+            # getconn raises once the pool is exhausted, so checkouts wait for a slot first
+            _connection_pools[pool_key] = (connection_pool, threading.BoundedSemaphore(max_connections))
+            print("PostgreSQL connection pool created successfully.")
+        return _connection_pools[pool_key]
+
+def close_connection_pools():
+    with _connection_pools_lock:
+        for connection_pool, _ in _connection_pools.values():
+            connection_pool.closeall()
+        _connection_pools.clear()
+
+def connection_is_healthy(connection):
+    if connection.closed:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+@contextmanager
+def postgres_session(db_params, statement_timeout=None):
+    # Check out a pooled connection, replacing it if it has gone stale, and hand it back
+    # with the session reset. statement_timeout is in milliseconds.
+    connection_pool, slots = get_connection_pool(db_params)
+    slots.acquire()
+    connection = None
+    try:
+        connection = connection_pool.getconn()
+        if not connection_is_healthy(connection):
+            connection_pool.putconn(connection, close=True)
+            connection = connection_pool.getconn()
+        if statement_timeout is not None:
+            with connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %s", (statement_timeout,))
+            connection.commit()
+        yield connection
+    finally:
+        if connection is not None:
+            try:
+                connection.reset()
+            except psycopg2.Error:
+                connection.close()
+            connection_pool.putconn(connection, close=bool(connection.closed))
+        slots.release()
+
 def table_exists(connection, table_name):
     try:
         cursor = connection.cursor()
@@ -32,32 +109,108 @@ def table_exists(connection, table_name):
         return table_exists
     except psycopg2.Error as e:
         print(f"Error checking if table exists: {e}")
+        connection.rollback()
         return False
 
-def create_table(connection, table_name, columns):
+def create_table(connection, table_name, columns, primary_key=None):
     try:
         cursor = connection.cursor()
         columns_def = ', '.join([f'"{col}" VARCHAR(255)' for col in columns])  # Adjust data types as needed
-        create_table_sql = f"CREATE TABLE {table_name} ({columns_def})"
+        primary_key_def = f', PRIMARY KEY ("{primary_key}")' if primary_key else ''
+        create_table_sql = f"CREATE TABLE {table_name} ({columns_def}{primary_key_def})"
         cursor.execute(create_table_sql)
         cursor.close()
         connection.commit()
         print(f"Table '{table_name}' created successfully.")
     except psycopg2.Error as e:
         print(f"Error creating table: {e}")
+        connection.rollback()
 
-def insert_data(connection, table_name, columns, data):
+def ensure_primary_key(connection, table_name, primary_key):
+    # ON CONFLICT needs a unique index on the key. Adds the primary key (or, if the table
+    # has a different one, a unique index) unless the stored rows have duplicate or NULL keys.
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT bool_or(a.attname = %s AND i.indnatts = 1 AND i.indpred IS NULL), bool_or(i.indisprimary)
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(%s) AND i.indisunique
+        """, (primary_key, table_name))
+        has_key, has_primary_key = cursor.fetchone()
+        if has_key:
+            connection.rollback()
+            return
+        cursor.execute(f'SELECT "{primary_key}", count(*) FROM {table_name} GROUP BY 1 HAVING count(*) > 1 OR "{primary_key}" IS NULL LIMIT 5')
+        duplicates = cursor.fetchall()
+        if duplicates:
+            print(f"Cannot add a key on '{table_name}.{primary_key}', it has duplicate or NULL values: {duplicates}")
+            connection.rollback()
+            return
+        if has_primary_key:
+            cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_{primary_key}_key ON {table_name} ("{primary_key}")')
+        else:
+            cursor.execute(f'ALTER TABLE {table_name} ADD PRIMARY KEY ("{primary_key}")')
+        cursor.close()
+        connection.commit()
+        print(f"Added key ({primary_key}) to table '{table_name}'.")
+    except psycopg2.Error as e:
+        print(f"Error adding key to table: {e}")
+        connection.rollback()
+
+def chunked(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def csv_buffer(rows):
+    # NULL is spelled \N so empty strings survive the round trip
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if cell is None else str(cell).lower() if isinstance(cell, bool) else cell for cell in row])
+    buffer.seek(0)
+    return buffer
+
+def insert_data(connection, table_name, columns, data, chunk_size=COPY_CHUNK_SIZE, use_copy=True):
+    # data may be any iterable of rows (e.g. a generator over ws.iter_rows); it is
+    # streamed in chunks through COPY ... FROM STDIN, or batched INSERTs if COPY is refused
     try:
         cursor = connection.cursor()
-        placeholders = ', '.join(['%s'] * len(columns))
         insert_columns = ', '.join([f'"{col}"' for col in columns])
-        insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders})'
-       
-        cursor.executemany(insert_sql, data)
+        copy_sql = f"COPY {table_name} ({insert_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES %s'
+
+        row_count = 0
+        for chunk in chunked(data, chunk_size):
+            if use_copy:
+                try:
+                    cursor.copy_expert(copy_sql, csv_buffer(chunk))
+                except (errors.InsufficientPrivilege, errors.FeatureNotSupported, psycopg2.NotSupportedError) as e:
+                    # Only the first chunk can fall back, nothing has been written yet
+                    if row_count:
+                        raise
+                    print(f"COPY not allowed, falling back to batched INSERT: {e}")
+                    connection.rollback()
+                    cursor = connection.cursor()
+                    use_copy = False
+            if not use_copy:
+                extras.execute_values(cursor, insert_sql, chunk, page_size=chunk_size)
+            row_count += len(chunk)
+
+        cursor.close()
         connection.commit()
-        print("Data inserted successfully.")
+        print(f"Data inserted successfully ({row_count} rows).")
+        return row_count
     except psycopg2.Error as e:
         print(f"Error inserting data: {e}")
+        connection.rollback()
+        return 0
 
 def update_or_insert_data(connection, table_name, columns, data, primary_key):
     try:
@@ -68,47 +221,116 @@ def update_or_insert_data(connection, table_name, columns, data, primary_key):
         insert_columns = ', '.join([f'"{col}"' for col in columns])
         placeholders = ', '.join(['%s'] * len(columns))
 
-        # Convert datetime objects to strings
-        data = [[str(cell) if isinstance(cell, datetime.datetime) else cell for cell in row] for row in data]
+        # Convert datetime objects to strings, lazily so the sheet is never held in memory
+        data = ([str(cell) if isinstance(cell, datetime.datetime) else cell for cell in row] for row in data)
 
         insert_sql = f'INSERT INTO {table_name} ({insert_columns}) VALUES ({placeholders}) ON CONFLICT ("{primary_key}") DO UPDATE SET {update_columns}'
 
-        cursor.executemany(insert_sql, data)
+        for chunk in chunked(data, COPY_CHUNK_SIZE):
+            cursor.executemany(insert_sql, chunk)
         connection.commit()
         print("Data updated/inserted successfully.")
     except psycopg2.Error as e:
         print(f"Error updating/inserting data: {e}")
+        connection.rollback()
+
+def merge_data(connection, table_name, columns, data, primary_key, chunk_size=COPY_CHUNK_SIZE):
+    # COPY the sheet into a temp staging table and apply it with one set-based upsert,
+    # all in a single transaction. Returns inserted/updated/unchanged counts.
+    try:
+        cursor = connection.cursor()
+        stage_table = f"{table_name}_stage"
+        insert_columns = ', '.join([f'"{col}"' for col in columns])
+        value_columns = [col for col in columns if col != primary_key]
+
+        cursor.execute(f"CREATE TEMP TABLE {stage_table} (LIKE {table_name}, merge_row_number BIGSERIAL) ON COMMIT DROP")
+        copy_sql = f"COPY {stage_table} ({insert_columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        staged_rows = 0
+        for chunk in chunked(data, chunk_size):
+            cursor.copy_expert(copy_sql, csv_buffer(chunk))
+            staged_rows += len(chunk)
+
+        if value_columns:
+            target_values = ', '.join([f't."{col}"' for col in value_columns])
+            stage_values = ', '.join([f's."{col}"' for col in value_columns])
+            changed_filter = f'OR ({target_values}) IS DISTINCT FROM ({stage_values})'
+            update_action = 'DO UPDATE SET ' + ', '.join([f'"{col}" = EXCLUDED."{col}"' for col in value_columns])
+        else:
+            changed_filter = ''
+            update_action = 'DO NOTHING'
+
+        # Later rows win when a key repeats in the sheet, as with the row-by-row upsert
+        merge_sql = f"""
+            WITH latest AS (
+                SELECT DISTINCT ON ("{primary_key}") * FROM {stage_table}
+                ORDER BY "{primary_key}", merge_row_number DESC
+            ), changed AS (
+                SELECT s.* FROM latest s
+                LEFT JOIN {table_name} t ON t."{primary_key}" = s."{primary_key}"
+                WHERE t."{primary_key}" IS NULL {changed_filter}
+            ), upserted AS (
+                INSERT INTO {table_name} ({insert_columns})
+                SELECT {insert_columns} FROM changed
+                ON CONFLICT ("{primary_key}") {update_action}
+                RETURNING (xmax = 0) AS inserted
+            )
+            SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted
+        """
+        cursor.execute(merge_sql)
+        inserted, updated = cursor.fetchone()
+        cursor.close()
+        connection.commit()
+
+        counts = {'inserted': inserted, 'updated': updated, 'unchanged': staged_rows - inserted - updated}
+        print(f"Data merged successfully: {counts}")
+        return counts
+    except psycopg2.Error as e:
+        print(f"Error merging data: {e}")
+        connection.rollback()
+        return None
+
+def read_excel_rows(excel_file_path):
+    # Read-only mode parses the sheet lazily; the returned generator yields one typed
+    # row at a time and closes the workbook once it is exhausted
+    wb = load_workbook(excel_file_path, read_only=True)
+    ws = wb.active
+    columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
 
-def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key):
+    def typed_rows():
+        try:
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                yield [str(cell) if isinstance(cell, (int, float, bool, datetime.datetime)) else cell for cell in row]
+        finally:
+            wb.close()
+
+    return columns, typed_rows()
+
+def load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key, chunk_size=COPY_CHUNK_SIZE, use_copy=True, merge=True, statement_timeout=None):
     try:
-        wb = load_workbook(excel_file_path)
-        ws = wb.active
-        print("Excel file read successfully.")
-
-        # Extract column names
-        columns = [cell.value.lower().replace(' ', '_') for cell in ws[1]]
-
-        # Extract data rows
-        data = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            data.append([str(cell) if isinstance(cell, (int, float, bool, datetime.datetime)) else cell for cell in row])
-       
+        columns, rows = read_excel_rows(excel_file_path)
+        print("Excel file opened for streaming.")
+
+        # Peek at the first rows without materializing the rest of the sheet
+        first_rows = list(islice(rows, 5))
+        rows = chain(first_rows, rows)
+
         print("Columns in the Excel file:", columns)
-        print("First few rows of data:", data[:5])
+        print("First few rows of data:", first_rows)
 
-        connection = create_postgres_connection(db_params)
-                 
-        if connection:
+        with postgres_session(db_params, statement_timeout) as connection:
             if table_exists(connection, table_name):
                 print(f"Table '{table_name}' already exists. Updating/inserting data...")
-                update_or_insert_data(connection, table_name, columns, data, primary_key)
+                ensure_primary_key(connection, table_name, primary_key)
+                if merge:
+                    merge_data(connection, table_name, columns, rows, primary_key, chunk_size)
+                else:
+                    update_or_insert_data(connection, table_name, columns, rows, primary_key)
             else:
                 print(f"Table '{table_name}' does not exist. Creating and inserting data.")
-                create_table(connection, table_name, columns)
-                insert_data(connection, table_name, columns, data)
-           
-            connection.close()
-            print("PostgreSQL Database connection closed.")
+                create_table(connection, table_name, columns, primary_key)
+                insert_data(connection, table_name, columns, rows, chunk_size, use_copy)
+
+        print("PostgreSQL Database connection returned to the pool.")
    
     except FileNotFoundError as e:
         print(f"Error: {e}")
@@ -136,6 +358,7 @@ excel_file_path = excel_file_path.replace('\u202a', '').replace('\u202b', '')
 
 # Call the function to create the table and ingest data
 load_excel_data_into_postgres(db_params, table_name, excel_file_path, primary_key)
+close_connection_pools()
 
 
 # In[ ]: